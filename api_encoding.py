@@ -0,0 +1,261 @@
+"""
+Encodings of the /api/v1/query/ responses, picked by the Accept header, and their compression, picked by Accept-Encoding
+An encoder writes a response piece by piece: head (the envelope), rows (one chunk at a time) and tail (what is only known once every row was read)
+"""
+import csv
+import io
+import json
+import zlib
+import werkzeug.datastructures
+import werkzeug.http
+import database.settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# content coding -> zlib wbits of its format
+CONTENT_CODINGS = {
+    'gzip': 31,
+    'deflate': 15,
+}
+
+
+class Encoder:
+    """Base of the encoders, a new one writes every response"""
+    # sent as the Content-Type, then the other media types accepted for this encoding
+    media_types = ()
+    # result format the rows have to be read in, None for the one asked with the 'format' param
+    row_format = None
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> str or bytes:
+        """
+        :param envelope: the API response with its database_response, without results, truncated, limit and the database error_message
+        :param columns: names of the result columns
+        :param ok: whether results follow
+        """
+        return ""
+
+    def rows(self, chunk: list) -> str or bytes:
+        return ""
+
+    def tail(self, trailer: dict) -> str or bytes:
+        """
+        :param trailer: truncated, limit and error_message of the database_response
+        """
+        return ""
+
+
+class JSONEncoder(Encoder):
+    """The json object of APIResponse.json, results included"""
+    media_types = ('application/json',)
+
+    def __init__(self):
+        self.ok = True
+        self.first = True
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> str:
+        self.ok = ok
+        database_response = envelope.pop('database_response')
+        return json.dumps(envelope)[:-1] + ', "database_response": ' + json.dumps(database_response)[:-1] + (', "results": [' if ok else ', "results": null')
+
+    def rows(self, chunk: list) -> str:
+        if not chunk:
+            return ""
+        piece = ("" if self.first else ", ") + ", ".join([json.dumps(row) for row in chunk])
+        self.first = False
+        return piece
+
+    def tail(self, trailer: dict) -> str:
+        return (']' if self.ok else '') + ''.join([f', "{key}": {json.dumps(value)}' for key, value in trailer.items()]) + '}}'
+
+
+class NDJSONEncoder(Encoder):
+    """One json value per line: the envelope, every row, then the trailer"""
+    media_types = ('application/x-ndjson', 'application/jsonlines')
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> str:
+        return json.dumps(envelope) + "\n"
+
+    def rows(self, chunk: list) -> str:
+        return "".join([json.dumps(row) + "\n" for row in chunk])
+
+    def tail(self, trailer: dict) -> str:
+        return json.dumps(trailer) + "\n"
+
+
+class CSVEncoder(Encoder):
+    """The columns as a header line then a line per row, without the envelope"""
+    media_types = ('text/csv',)
+    row_format = 'rows'
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def drain(self) -> str:
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> str:
+        if columns:
+            self.writer.writerow(columns)
+        return self.drain()
+
+    def rows(self, chunk: list) -> str:
+        self.writer.writerows(chunk)
+        return self.drain()
+
+    def tail(self, trailer: dict) -> str:
+        if trailer['error_message']:
+            # nowhere to put it, the response is cut short instead of looking complete
+            raise Exception(trailer['error_message'])
+        return ""
+
+
+class MessagePackEncoder(Encoder):
+    """Same values as NDJSON, one MessagePack object after the other (read them with msgpack.Unpacker)"""
+    media_types = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+    def __init__(self):
+        self.packer = msgpack.Packer()
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> bytes:
+        return self.packer.pack(envelope)
+
+    def rows(self, chunk: list) -> bytes:
+        return b"".join([self.packer.pack(row) for row in chunk])
+
+    def tail(self, trailer: dict) -> bytes:
+        return self.packer.pack(trailer)
+
+
+class ArrowEncoder(Encoder):
+    """
+    Arrow IPC stream: a record batch per chunk, the envelope as json in the schema metadata ('database_api')
+    Column types are taken from the first chunk, columns mixing types (or only null in it) are sent as strings
+    """
+    media_types = ('application/vnd.apache.arrow.stream',)
+    row_format = 'rows'
+
+    def __init__(self):
+        self.sink = io.BytesIO()
+        self.writer = None
+        self.schema = None
+        self.columns = None
+        self.metadata = None
+
+    def drain(self) -> bytes:
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    @staticmethod
+    def array(values: list, arrow_type=None):
+        try:
+            array = pyarrow.array(values, type=arrow_type)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            if arrow_type is not None and not pyarrow.types.is_string(arrow_type):
+                raise
+            array = None
+        if array is None or pyarrow.types.is_null(array.type):
+            array = pyarrow.array([None if value is None else str(value) for value in values], type=pyarrow.string())
+        return array
+
+    def start(self, arrays: list) -> None:
+        self.schema = pyarrow.schema([pyarrow.field(name, array.type) for name, array in zip(self.columns, arrays)], metadata=self.metadata)
+        self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def head(self, envelope: dict, columns: list or None, ok: bool) -> bytes:
+        self.columns = columns or []
+        self.metadata = {'database_api': json.dumps(envelope)}
+        return b""
+
+    def rows(self, chunk: list) -> bytes:
+        if not chunk:
+            return b""
+        values = [list(column) for column in zip(*chunk)]
+        if self.writer is None:
+            arrays = [self.array(column) for column in values]
+            self.start(arrays)
+        else:
+            arrays = []
+            for name, column, field in zip(self.columns, values, self.schema):
+                try:
+                    arrays.append(self.array(column, field.type))
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                    raise Exception(f"Column {name} can't be sent as {field.type}, its type changed after the first rows")
+        self.writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        return self.drain()
+
+    def tail(self, trailer: dict) -> bytes:
+        if trailer['error_message']:
+            raise Exception(trailer['error_message'])
+        if self.writer is None:
+            self.start([pyarrow.array([], type=pyarrow.string()) for _ in self.columns])
+        self.writer.close()
+        return self.drain()
+
+
+# encoding name -> encoder, json first as it is the answer to */*
+ENCODERS = {
+    'json': JSONEncoder,
+    'ndjson': NDJSONEncoder,
+    'csv': CSVEncoder,
+}
+if msgpack is not None:
+    ENCODERS['msgpack'] = MessagePackEncoder
+if pyarrow is not None:
+    ENCODERS['arrow'] = ArrowEncoder
+
+# media type -> encoding name
+MEDIA_TYPES = {media_type: name for name, encoder in ENCODERS.items() for media_type in encoder.media_types}
+
+
+def negotiate(accept: str or None) -> str or None:
+    """Return the name of the encoding best matching an Accept header (json when there is none), None when nothing offered is acceptable"""
+    if not accept:
+        return 'json'
+    media_type = werkzeug.http.parse_accept_header(accept, werkzeug.datastructures.MIMEAccept).best_match(list(MEDIA_TYPES))
+    return None if media_type is None else MEDIA_TYPES[media_type]
+
+
+def negotiate_coding(accept_encoding: str or None) -> str or None:
+    """Return the content coding best matching an Accept-Encoding header, None to send the body as it is"""
+    if not accept_encoding or not database.settings.COMPRESSION_ENABLED:
+        return None
+    return werkzeug.http.parse_accept_header(accept_encoding).best_match(list(CONTENT_CODINGS))
+
+
+def content_type(encoding: str) -> str:
+    media_type = ENCODERS[encoding].media_types[0]
+    return media_type + '; charset=utf-8' if media_type == 'text/csv' else media_type
+
+
+def compressor(content_coding: str):
+    return zlib.compressobj(database.settings.COMPRESSION_LEVEL, zlib.DEFLATED, CONTENT_CODINGS[content_coding])
+
+
+def compress(body: bytes, content_coding: str) -> bytes:
+    compress_object = compressor(content_coding)
+    return compress_object.compress(body) + compress_object.flush()
+
+
+def compressed(pieces, content_coding: str):
+    """Compress a stream of bytes, every piece is flushed so the client gets the rows of a chunk as soon as they are read"""
+    compress_object = compressor(content_coding)
+    for piece in pieces:
+        data = compress_object.compress(piece) + compress_object.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compress_object.flush()
@@ -1,8 +1,21 @@
+import api_encoding
 import database.response
+import database.metrics
+import database.settings
 import json
+import logging
+import math
 import flask
 import urllib.parse
+import uuid
 import database.root.types.use
+import database.root.types.token
+import database.root.ratelimit
+
+logger = logging.getLogger(__name__)
+
+# stands for results serialized beforehand while the rest of the response is serialized
+RESULTS_PLACEHOLDER = json.dumps(uuid.uuid4().hex)
 
 
 class APIResponse:
@@ -27,13 +40,110 @@ class APIResponse:
         self.token = token_token
         self.database_response = database_response
         self.error_message = error_message
+        self._retry_after = None  # seconds the client should wait before trying again (Retry-After header)
+        self._rows = 0  # rows written by pieces
+        logger.info("%r", self)
+
+    def get_response(self, encoding: str = 'json', content_coding: str or None = None) -> flask.Response:
+        """
+        Return flask response of this class, logging the use of the token (if any)
+        :param encoding: name of the api_encoding.ENCODERS writing the body, errors are always sent as json
+        :param content_coding: compression of the body, only used for bodies of at least COMPRESSION_MIN_BYTES
+        """
+        encoding = self.encoding(encoding)
+        body, content_coding = self.encode(encoding, content_coding)
+        return flask.Response(response=body, status=self.status, headers=self.headers(content_coding), content_type=api_encoding.content_type(encoding))
+
+    def encoding(self, encoding: str) -> str:
+        """Return the encoding the body is actually written in: the one asked for, unless this is an error"""
+        if self.ok and self.database_response is not None and self.database_response.ok:
+            return encoding
+        return 'json'
+
+    def headers(self, content_coding: str or None = None) -> dict:
+        """Return the http headers of this class, other than the content type"""
+        headers = {'Vary': 'Accept, Accept-Encoding'}
+        if content_coding is not None:
+            headers['Content-Encoding'] = content_coding
+        if self.database_response is not None and self.database_response.truncated:
+            # the only way csv and arrow bodies tell it
+            headers['X-Results-Truncated'] = 'true'
+        if self.database_response is not None and self.database_response.cursor is not None:
+            headers['X-Cursor'] = self.database_response.cursor
+        if self._retry_after is not None:
+            headers['Retry-After'] = str(math.ceil(self._retry_after))
+        return headers
+
+    def encode(self, encoding: str = 'json', content_coding: str or None = None) -> (bytes, str or None):
+        """
+        Return the body sent back for this class and its content coding (None when it wasn't compressed), logging the use of the token (if any)
+        """
+        with database.metrics.SERIALIZATION_SECONDS.time():
+            if encoding == 'json':
+                body = self.json().encode()
+            else:
+                body = b"".join([piece.encode() if type(piece) is str else piece for piece in self.pieces(api_encoding.ENCODERS[encoding](), [self.database_response.rows()])])
+            if content_coding is not None and len(body) >= database.settings.COMPRESSION_MIN_BYTES:
+                body = api_encoding.compress(body, content_coding)
+            else:
+                content_coding = None
+        self.log_use(len(body))
+        return body, content_coding
+
+    def log_use(self, response_bytes: int, rows: int or None = None) -> None:
         if self.token:
-            print("OK" if database.root.types.use.Use.create(self) else "KO")
-        print(self)
+            with database.metrics.USAGE_ENQUEUE_SECONDS.time():
+                queued = database.root.types.use.Use.create(self, response_bytes, rows=rows)
+            if not queued:
+                logger.warning("Use of token dropped, the usage log queue is full")
 
-    def get_response(self) -> flask.Response:
-        """Return flask response of this class"""
-        return flask.Response(response=self.json(), status=self.status, mimetype='application/json')
+    def get_stream_response(self, chunks, encoding: str = 'json', content_coding: str or None = None) -> flask.Response:
+        """
+        Return flask response of this class that writes the results while they are read from the database
+        :param chunks: iterable of lists of rows, the results of database_response
+        :param encoding: name of the api_encoding.ENCODERS writing the body, errors found before the first row are sent as json
+        :param content_coding: compression of the body
+        """
+        encoding = self.encoding(encoding)
+        return flask.Response(response=self.stream(chunks, encoding, content_coding), status=self.status, headers=self.headers(content_coding), content_type=api_encoding.content_type(encoding))
+
+    def stream(self, chunks, encoding: str = 'json', content_coding: str or None = None):
+        """Generate the body of a streamed response in bytes, logging the use of the token (if any) once it was sent"""
+        sent = 0
+        try:
+            body = (piece.encode() if type(piece) is str else piece for piece in self.pieces(api_encoding.ENCODERS[encoding](), chunks))
+            if content_coding is not None:
+                body = api_encoding.compressed(body, content_coding)
+            for piece in body:
+                if piece:
+                    sent += len(piece)
+                    yield piece
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.log_use(sent, rows=self._rows)
+
+    def pieces(self, encoder: api_encoding.Encoder, chunks):
+        """
+        Generate the representation of the class piece by piece through encoder, holding at most one chunk of rows in memory
+        An error raised while reading chunks ends the results and is reported as the database_response error_message
+        """
+        envelope = self.json_object()
+        database_response = envelope.pop('database_response').json_object()
+        database_response.pop('results')
+        # known once every row was read, sent last
+        error_message = database_response.pop('error_message')
+        database_response.pop('truncated')
+        database_response.pop('limit')
+        envelope['database_response'] = database_response
+        yield encoder.head(envelope, self.database_response.columns, self.database_response.ok)
+        try:
+            for chunk in chunks:
+                self._rows += len(chunk)
+                yield encoder.rows(chunk)
+        except Exception as e:
+            error_message = str(e)
+        yield encoder.tail({'truncated': self.database_response.truncated, 'limit': self.database_response.limit, 'error_message': error_message})
 
     @classmethod
     def good(cls, *, query: str, token_token: str or None = None, database_response: database.response.DatabaseResponse):
@@ -43,6 +153,20 @@ class APIResponse:
     def bad(cls, *, query: str, token_token: str or None = None, error_message: str or None):
         return cls(status=400, query=query, token_token=token_token, error_message=error_message)
 
+    @classmethod
+    def too_many_requests(cls, *, query: str, error_message: str, retry_after: float):
+        """Response to a request over the rate limit or quota of its token, which isn't logged as a use of the token"""
+        response = cls(status=429, query=query, error_message=error_message)
+        response._retry_after = retry_after
+        return response
+
+    @classmethod
+    def unavailable(cls, *, query: str, token_token: str or None = None, error_message: str):
+        """Response to a request the server is too busy to answer (no database connection became available in time)"""
+        response = cls(status=503, query=query, token_token=token_token, error_message=error_message)
+        response._retry_after = database.settings.POOL_RETRY_AFTER
+        return response
+
     @property
     def ok(self) -> bool:
         """Retrun whether the request succeeded"""
@@ -54,11 +178,38 @@ class APIResponse:
 
     def json_object(self):
         """Return json object representation of the class"""
-        return self.__dict__
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
 
     def json(self, **kwargs) -> str:
         """Return json representation of the class"""
-        return json.dumps(self.json_object(), default=lambda o: o.json_object(), **kwargs)
+        if self.database_response is None or self.database_response._results_json is None:
+            return json.dumps(self.json_object(), default=lambda o: o.json_object(), **kwargs)
+        # results serialized beforehand (cached, or by a query worker process) are sent as they are
+        envelope = self.json_object()
+        envelope['database_response'] = dict(self.database_response.json_object(), results=json.loads(RESULTS_PLACEHOLDER))
+        return json.dumps(envelope, **kwargs).replace(RESULTS_PLACEHOLDER, self.database_response._results_json, 1)
+
+
+def authorize(query: str, token_token: str or None) -> (database.root.types.token.Token or None, APIResponse or None):
+    """
+    Authenticate the token of an API request and count the request against its rate limit, for the Flask and the ASGI apps alike
+    :param query: url of the request, for the error response
+    :return: (token, None) if the request may go on, (None, error response) if it may not
+    """
+    if not token_token:
+        return None, APIResponse.bad(query=query, error_message="Missing token")
+    try:
+        token = database.root.types.token.Token.authenticate(token_token)
+    except Exception:
+        return None, APIResponse.bad(query=query, error_message="Invalid token")
+    if not token:
+        return None, APIResponse.bad(query=query, error_message="Token not found")
+    if token.token_active != 1:
+        return None, APIResponse.bad(query=query, error_message="Token not active")
+    error_message, retry_after = database.root.ratelimit.LIMITER.check(token)
+    if error_message:
+        return None, APIResponse.too_many_requests(query=query, error_message=error_message, retry_after=retry_after)
+    return token, None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+"""
+asyncio (ASGI) entry point for /api/v1/query/, served next to the Flask app by any ASGI server, e.g.
+    uvicorn async_server:app --host 0.0.0.0 --port 8246
+Waiting clients only cost a coroutine, SQLite work runs on a small thread pool per database
+"""
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+import urllib.parse
+import api_encoding
+import api_response
+import database.log
+import database.pool
+import database.settings
+import database.user
+import database.root.types.token
+
+database.log.setup()
+logger = logging.getLogger(__name__)
+
+
+class DatabaseExecutors:
+    """
+    A bounded thread pool per database, so a few busy databases can't take every worker thread
+    At most max_databases pools are kept, the least recently used one is shut down (its running queries still finish)
+    """
+
+    def __init__(self, *, threads_per_database: int, max_databases: int):
+        """
+        :param threads_per_database: maximum queries of one database running at the same time, the others wait in line
+        :param max_databases: maximum amount of thread pools kept
+        """
+        assert type(threads_per_database) is int and threads_per_database > 0
+        assert type(max_databases) is int and max_databases > 0
+
+        self.threads_per_database = threads_per_database
+        self.max_databases = max_databases
+        self.lock = threading.Lock()
+        self.executors = collections.OrderedDict()  # key -> executor, least recently used first
+
+    def get(self, key) -> concurrent.futures.ThreadPoolExecutor:
+        with self.lock:
+            executor = self.executors.get(key)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads_per_database, thread_name_prefix="query")
+                self.executors[key] = executor
+                while len(self.executors) > self.max_databases:
+                    self.executors.popitem(last=False)[1].shutdown(wait=False)
+            self.executors.move_to_end(key)
+            return executor
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executors, self.executors = self.executors, collections.OrderedDict()
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+
+class QueryJob:
+    """One query run by a worker thread, which the event loop can interrupt while it runs or before it starts"""
+
+    def __init__(self, token: database.root.types.token.Token, query: str, result_format: str, cache: bool):
+        self.token = token
+        self.query = query
+        self.result_format = result_format
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.conn = None  # connection running the query, only set while it runs
+        self.cancelled = False
+
+    def run(self):
+        """
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        with database.user.UserDatabase(self.token.user_email, self.token.token_database_name, limits=self.token.limits) as db:
+            with self.lock:
+                if self.cancelled:
+                    raise Exception("Query cancelled")
+                self.conn = db.conn
+            try:
+                return db.execute(self.query, self.result_format, cache=self.cache)
+            finally:
+                with self.lock:
+                    # the connection goes back to the pool next, it must not be interrupted anymore
+                    self.conn = None
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.interrupt()
+
+
+EXECUTORS = DatabaseExecutors(
+    threads_per_database=database.settings.ASYNC_THREADS_PER_DATABASE,
+    max_databases=database.settings.ASYNC_MAX_DATABASE_EXECUTORS,
+)
+
+
+def request_url(scope: dict) -> str:
+    host = dict(scope['headers']).get(b'host', b'').decode('latin-1')
+    url = f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}{scope['path']}"
+    if scope.get('query_string'):
+        url += "?" + scope['query_string'].decode('latin-1')
+    return url
+
+
+async def wait_disconnect(receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_response(send, response: api_response.APIResponse, encoding: str = 'json', content_coding: str or None = None) -> None:
+    encoding = response.encoding(encoding)
+    # serializing (and queuing the usage record) may take a while for big results, keep it off the event loop
+    body, content_coding = await asyncio.get_running_loop().run_in_executor(None, response.encode, encoding, content_coding)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status,
+        'headers': [(b'content-type', api_encoding.content_type(encoding).encode()), (b'content-length', str(len(body)).encode())] + [(name.lower().encode(), value.encode()) for name, value in response.headers(content_coding).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def database_use(url: str, args: dict, receive, row_format: str or None = None) -> api_response.APIResponse or None:
+    """
+    Same API as the Flask /api/v1/query/ (without stream and paged queries, whose cursors live in the Flask process)
+    :param row_format: result format required by the encoding of the response, overriding the 'format' param
+    :return: the response, None if the client went away before the query finished
+    """
+    loop = asyncio.get_running_loop()
+    # root.db is read on a token cache miss
+    token, error_response = await loop.run_in_executor(None, api_response.authorize, url, args.get('token'))
+    if error_response is not None:
+        return error_response
+
+    if 'page_size' in args or 'cursor' in args:
+        return api_response.APIResponse.bad(query=url, token_token=token.token_token, error_message="Paged queries (page_size, cursor) are only served by the Flask app")
+    query = args.get('q')
+    if query is None:
+        return api_response.APIResponse.bad(query=url, token_token=token.token_token, error_message="Arguments missing: q")
+    result_format = args.get('format', 'objects')
+    if result_format not in database.user.RESULT_FORMATS:
+        return api_response.APIResponse.bad(query=url, token_token=token.token_token, error_message=f"Invalid format: {result_format}")
+    result_format = row_format or result_format
+
+    job = QueryJob(token, query, result_format, cache=bool(args.get('cache')))
+    executor = EXECUTORS.get((token.user_email, token.token_database_name))
+    future = loop.run_in_executor(executor, job.run)
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({future, disconnect}, timeout=database.settings.ASYNC_QUERY_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        job.cancel()
+        raise
+    finally:
+        disconnect.cancel()
+
+    if future in done:
+        try:
+            database_response = future.result()
+        except database.pool.PoolTimeout:
+            return api_response.APIResponse.unavailable(query=url, token_token=token.token_token, error_message="Server too busy, no database connection became available in time")
+        except Exception as e:
+            return api_response.APIResponse.bad(query=url, token_token=token.token_token, error_message=str(e))
+        return api_response.APIResponse.good(query=url, token_token=token.token_token, database_response=database_response)
+
+    job.cancel()
+    if disconnect in done:
+        logger.info("Client went away, query cancelled: %s", url)
+        return None
+    return api_response.APIResponse.bad(query=url, token_token=token.token_token, error_message=f"Query timed out after {database.settings.ASYNC_QUERY_TIMEOUT} seconds")
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            EXECUTORS.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope: dict, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    url = request_url(scope)
+    if scope['path'].rstrip('/') != '/api/v1/query':
+        return await send_response(send, api_response.APIResponse(status=404, query=url, error_message="Not found"))
+    if scope['method'] != 'GET':
+        return await send_response(send, api_response.APIResponse(status=405, query=url, error_message=f"Method not allowed: {scope['method']}"))
+
+    args = {key: values[0] for key, values in urllib.parse.parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    encoding = api_encoding.negotiate(headers.get('accept'))
+    if encoding is None:
+        return await send_response(send, api_response.APIResponse(status=406, query=url, error_message=f"Not acceptable, the results can be sent as: {', '.join(api_encoding.MEDIA_TYPES)}"))
+    content_coding = api_encoding.negotiate_coding(headers.get('accept-encoding'))
+    response = await database_use(url, args, receive, api_encoding.ENCODERS[encoding].row_format)
+    if response is not None:
+        await send_response(send, response, encoding, content_coding)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=8246)
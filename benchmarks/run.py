@@ -0,0 +1,283 @@
+"""
+Load test of /api/v1/query/ through the Flask app, on a temporary root.db and tenant databases
+    python benchmarks/run.py --clients 8 --requests 2000 --output before.json
+    python benchmarks/run.py --clients 8 --requests 2000 --output after.json --compare before.json
+Every scenario reports its throughput, latency percentiles and the time spent per stage (read from database.metrics)
+The same --seed gives the same requests, so runs of different commits can be compared
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stage -> histogram of database.metrics timing it
+STAGES = {
+    'auth': 'AUTH_SECONDS',
+    'pool_acquire': 'POOL_ACQUIRE_SECONDS',
+    'lock_wait': 'LOCK_WAIT_SECONDS',
+    'execute': 'QUERY_EXECUTE_SECONDS',
+    'fetch': 'QUERY_FETCH_SECONDS',
+    'serialization': 'SERIALIZATION_SECONDS',
+    'usage_enqueue': 'USAGE_ENQUEUE_SECONDS',
+}
+
+
+def tiny_lookup(rng: random.Random, tokens: list, args) -> (str, str):
+    return tokens[0], f"SELECT * FROM items WHERE id = {rng.randint(1, args.rows)}"
+
+
+def wide_scan(rng: random.Random, tokens: list, args) -> (str, str):
+    return tokens[0], f"SELECT * FROM items WHERE id > {rng.randint(0, max(args.rows - args.scan_rows, 0))} LIMIT {args.scan_rows}"
+
+
+def write_ingest(rng: random.Random, tokens: list, args) -> (str, str):
+    return tokens[0], f"INSERT INTO events (payload, created) VALUES ('{rng.getrandbits(128):032x}', datetime('now'))"
+
+
+def fan_out(rng: random.Random, tokens: list, args) -> (str, str):
+    return rng.choice(tokens), f"SELECT * FROM items WHERE id = {rng.randint(1, args.rows)}"
+
+
+# scenario -> function returning the (token, query) of the next request
+SCENARIOS = {
+    'tiny_lookup': tiny_lookup,
+    'wide_scan': wide_scan,
+    'write_ingest': write_ingest,
+    'fan_out': fan_out,
+}
+
+
+def configure(directory: str, log_level: str, processes: int) -> None:
+    """Point the app to a temporary config and data directory, must run before anything of the app is imported"""
+    config = {
+        'token_secret_key': 'benchmark',
+        'flask_secret_key': 'benchmark',
+        'GMAIL_APP_PASSWORD': '',
+        'ROOT_RELATIVE_PATH': os.path.join(directory, 'root'),
+        'USER_RELATIVE_PATH': os.path.join(directory, 'user'),
+        'LOG_LEVEL': log_level,
+        'METRICS_ENABLED': True,
+        'EXECUTOR_PROCESSES': processes,
+    }
+    config_path = os.path.join(directory, 'config.json')
+    with open(config_path, 'w') as file:
+        json.dump(config, file)
+    os.environ['DATABASE_API_CONFIG'] = config_path
+    sys.path.insert(0, ROOT)
+
+    import database.settings
+    # the query limits of the default tier, without its rate limit and quota
+    database.settings.TOKEN_TIERS['benchmark'] = dict(database.settings.TOKEN_TIERS.get('default', {}), rate=None, burst=None, daily_quota=None)
+
+
+def seed(tenants: int, rows: int) -> list:
+    """
+    Create a user, an active token and a database with rows items for every tenant
+    :return: the tokens
+    """
+    import database.root
+    import database.user
+
+    tokens = []
+    items = [(number, f"item {number}", number * 0.5, "2020-01-01 00:00:00") for number in range(1, rows + 1)]
+    with database.root.RootDatabase() as root_db:
+        for number in range(tenants):
+            user = root_db.insert_user(user_fullname=f"Benchmark {number}", user_email=f"benchmark{number}@example.com", user_password="benchmark")
+            token = root_db.insert_token(user_id=user.user_id, token_token=f"benchmark-{number}", token_database_name="benchmark")
+            root_db.update_token(token_id=token.token_id, token_active=1, token_tier='benchmark')
+            tokens.append(token.token_token)
+            with database.user.UserDatabase(user.user_email, "benchmark") as db:
+                response = db.execute_batch([
+                    {'q': "CREATE TABLE items (id integer primary key, name text, value real, created text)"},
+                    {'q': "CREATE TABLE events (id integer primary key, payload text, created text)"},
+                    {'q': "INSERT INTO items VALUES (?, ?, ?, ?)", 'many': items},
+                ])
+                if not response.ok:
+                    raise Exception(f"Could not seed tenant {number}: {response.error_message}")
+    return tokens
+
+
+def stage_totals() -> dict:
+    """Return {stage: (observations, seconds)} so far"""
+    import database.metrics
+
+    totals = {}
+    for stage, name in STAGES.items():
+        histogram = getattr(database.metrics, name)
+        with histogram.lock:
+            totals[stage] = (sum([series[2] for series in histogram.series.values()]), sum([series[1] for series in histogram.series.values()]))
+    return totals
+
+
+def percentile(quantiles: list, number: int) -> float:
+    return round(quantiles[number - 1] * 1000, 3)
+
+
+def run_scenario(app, name: str, tokens: list, args) -> dict:
+    scenario = SCENARIOS[name]
+
+    def client(number: int, count: int, seed_offset: int) -> list:
+        rng = random.Random(args.seed * 1000 + seed_offset + number)
+        test_client = app.test_client()
+        headers = {name: value for name, value in (('Accept', args.accept), ('Accept-Encoding', args.accept_encoding)) if value}
+        results = []
+        for _ in range(count):
+            token, query = scenario(rng, tokens, args)
+            url = '/api/v1/query/?' + urllib.parse.urlencode({'q': query, 'token': token})
+            start = time.perf_counter()
+            response = test_client.get(url, headers=headers)
+            body = response.get_data()
+            elapsed = time.perf_counter() - start
+            # errors are always sent as json, uncompressed when small
+            ok = response.status_code == 200 and (response.mimetype != 'application/json' or 'Content-Encoding' in response.headers or json.loads(body)['database_response']['status'] == 200)
+            results.append((elapsed, ok, len(body)))
+        return results
+
+    def run(total: int, seed_offset: int) -> list:
+        counts = [total // args.clients + (number < total % args.clients) for number in range(args.clients)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.clients) as executor:
+            futures = [executor.submit(client, number, count, seed_offset) for number, count in enumerate(counts)]
+            return [result for future in futures for result in future.result()]
+
+    if args.warmup:
+        run(args.warmup, 500)
+    before = stage_totals()
+    start = time.perf_counter()
+    results = run(args.requests, 0)
+    seconds = time.perf_counter() - start
+    after = stage_totals()
+
+    latencies = sorted([elapsed for elapsed, _, _ in results])
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    stages = {}
+    for stage in STAGES:
+        count = after[stage][0] - before[stage][0]
+        total = after[stage][1] - before[stage][1]
+        stages[stage] = {
+            'count': count,
+            'total_seconds': round(total, 6),
+            'mean_ms': round(total / count * 1000, 4) if count else None,
+            'per_request_ms': round(total / len(results) * 1000, 4),
+        }
+    return {
+        'requests': len(results),
+        'errors': len([ok for _, ok, _ in results if not ok]),
+        'seconds': round(seconds, 4),
+        'throughput': round(len(results) / seconds, 2),
+        'bytes_per_request': round(sum([size for _, _, size in results]) / len(results), 1),
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies) * 1000, 3),
+            'p50': percentile(quantiles, 50),
+            'p90': percentile(quantiles, 90),
+            'p99': percentile(quantiles, 99),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'stages': stages,
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def report(name: str, result: dict, previous: dict or None) -> None:
+    latency = result['latency_ms']
+    line = f"{name:<14} {result['throughput']:>10.1f} req/s  p50 {latency['p50']:>8.2f} ms  p90 {latency['p90']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms  errors {result['errors']}"
+    if previous:
+        def change(new: float, old: float) -> str:
+            return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+        line += f"  (throughput {change(result['throughput'], previous['throughput'])}, p50 {change(latency['p50'], previous['latency_ms']['p50'])}, p99 {change(latency['p99'], previous['latency_ms']['p99'])})"
+    print(line)
+    stages = ", ".join([f"{stage} {values['per_request_ms']:.3f}" for stage, values in result['stages'].items() if values['count']])
+    print(f"{'':<14} ms per request: {stages}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--requests', type=int, default=1000, help="measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=100, help="requests per scenario sent before measuring")
+    parser.add_argument('--tenants', type=int, default=20, help="tenant databases (fan_out spreads the requests over them)")
+    parser.add_argument('--rows', type=int, default=10000, help="rows of the items table of each tenant")
+    parser.add_argument('--scan-rows', type=int, default=1000, help="rows returned by each wide_scan request")
+    parser.add_argument('--processes', type=int, default=0, help="query worker processes (EXECUTOR_PROCESSES), 0 runs the queries in the request threads")
+    parser.add_argument('--accept', help="Accept header of the requests, e.g. text/csv")
+    parser.add_argument('--accept-encoding', help="Accept-Encoding header of the requests, e.g. gzip")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--compare', help="json file of a previous run to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary databases")
+    args = parser.parse_args()
+    assert args.clients > 0 and args.requests > 0 and args.tenants > 0 and args.rows > 0
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)['scenarios']
+
+    directory = tempfile.mkdtemp(prefix="database-api-benchmark-")
+    try:
+        configure(directory, args.log_level, args.processes)
+        import server
+        import database.pool
+        import database.root.ratelimit
+        import database.root.usage
+        import database.user.executor
+
+        start = time.perf_counter()
+        tokens = seed(args.tenants, args.rows)
+        print(f"Seeded {args.tenants} tenants of {args.rows} rows in {time.perf_counter() - start:.1f}s ({directory})")
+
+        results = {
+            'started': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'environment': environment(),
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')},
+            'scenarios': {},
+        }
+        for name in args.scenarios:
+            results['scenarios'][name] = run_scenario(server.app, name, tokens, args)
+            report(name, results['scenarios'][name], (previous or {}).get(name))
+
+        database.root.usage.WRITER.stop()
+        results['usage_writer'] = database.root.usage.WRITER.stats()
+        database.root.ratelimit.LIMITER.stop()
+        if database.user.executor.EXECUTOR is not None:
+            database.user.executor.EXECUTOR.stop()
+        database.pool.POOL.close_all()
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=4)
+            print(f"Results written to {args.output}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Thread safe mapping that keeps at most max_size entries (least recently used go first) for ttl seconds each
+    An entry may have an alias, a second key it can be invalidated by
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: maximum amount of entries
+        :param ttl: seconds an entry stays valid
+        """
+        assert type(max_size) is int and max_size > 0
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (expiration, value, alias), least recently used first
+        self.aliases = {}  # alias -> key
+        self.generation = 0  # invalidations so far, see set
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        :return: (whether key is cached, cached value) so that None can be cached too
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                self._drop(key)
+            self.misses += 1
+            return False, None
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key, value, alias=None, generation: int or None = None) -> None:
+        """
+        :param alias: second key of the entry, for invalidate_alias
+        :param generation: the generation read before value was computed, value is not cached if anything was invalidated since (it may be stale)
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value, alias)
+            if alias is not None:
+                self._drop(self.aliases.get(alias))
+                self.aliases[alias] = key
+            while len(self.entries) > self.max_size:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate(self, key) -> None:
+        with self.lock:
+            self.generation += 1
+            self._drop(key)
+
+    def invalidate_alias(self, alias) -> None:
+        with self.lock:
+            self.generation += 1
+            self._drop(self.aliases.get(alias))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.aliases.clear()
+
+    def _drop(self, key) -> None:
+        """Remove the entry of key (if any) and its alias, the lock must be held"""
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[2] is not None and self.aliases.get(entry[2]) == key:
+            del self.aliases[entry[2]]
+
+    def __len__(self) -> int:
+        return len(self.entries)
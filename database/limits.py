@@ -0,0 +1,137 @@
+import contextlib
+import logging
+import sqlite3
+import time
+import database.settings
+import database.locks
+
+logger = logging.getLogger(__name__)
+
+
+def tier_settings(tier: str) -> dict:
+    """Return the TOKEN_TIERS settings of tier, the default ones if it is unknown (an empty tier, such as 'unlimited', has no limit at all)"""
+    if tier in database.settings.TOKEN_TIERS:
+        return database.settings.TOKEN_TIERS[tier]
+    return database.settings.TOKEN_TIERS.get('default', {})
+
+
+class QueryLimits:
+    """Resource guards of the queries run through one token, configured per tier in TOKEN_TIERS"""
+
+    KEYS = ('timeout', 'max_rows', 'max_bytes', 'sqlite_limits')  # settings of a tier read by this class
+
+    def __init__(self, *, timeout: float or None = None, max_rows: int or None = None, max_bytes: int or None = None, sqlite_limits: dict or None = None):
+        """
+        :param timeout: seconds a query may take (lock wait included) before it is interrupted, None for no limit
+        :param max_rows: rows returned at most, the others are left out and the response is marked truncated
+        :param max_bytes: maximum size of the results (serialized), bigger results are an error
+        :param sqlite_limits: {name: value} set with Connection.setlimit while the query runs, name is a SQLITE_LIMIT_* constant without its prefix
+        """
+        assert timeout is None or timeout > 0
+        assert max_rows is None or (type(max_rows) is int and max_rows >= 0)
+        assert max_bytes is None or (type(max_bytes) is int and max_bytes >= 0)
+
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.sqlite_limits = {}  # SQLITE_LIMIT_* category -> value
+        for name, value in (sqlite_limits or {}).items():
+            category = getattr(sqlite3, f"SQLITE_LIMIT_{name.upper()}", None)
+            if category is None:
+                raise Exception(f"Unknown sqlite limit: {name}")
+            self.sqlite_limits[category] = value
+
+    @classmethod
+    def for_tier(cls, tier: str) -> 'QueryLimits':
+        limits = TIERS.get(tier)
+        if limits is None:
+            logger.warning("Unknown token tier %r, using the default one", tier)
+            limits = TIERS['default']
+        return limits
+
+    def allows(self, response) -> bool:
+        """Return whether the results of response (already computed, e.g. cached) are within these limits"""
+        if self.max_rows is not None and (response._rows or 0) > self.max_rows:
+            return False
+        if self.max_bytes is not None and response._results_json is not None and len(response._results_json) > self.max_bytes:
+            return False
+        return True
+
+
+class QueryGuard:
+    """
+    Enforces QueryLimits on a connection while it runs a query
+    The deadline is checked by a progress handler, which interrupts the query once it passed (expired tells why it failed)
+    The database lock is taken through lock, so the time spent waiting for it counts against the timeout too
+    Usable as a context manager, or through start and stop when the query outlives a single call (streams)
+    """
+
+    def __init__(self, limits: QueryLimits or None, conn: sqlite3.Connection):
+        """
+        :param limits: limits to enforce, None for none
+        """
+        self.limits = limits
+        self.conn = conn
+        self.deadline = None
+        self.expired = False
+        self.previous = {}  # SQLITE_LIMIT_* category -> value before start
+
+    def start(self) -> None:
+        if self.limits is None:
+            return
+        self.restart()
+        if self.limits.timeout is not None:
+            self.conn.set_progress_handler(self.progress, database.settings.QUERY_PROGRESS_STEPS)
+        if hasattr(self.conn, 'setlimit'):  # python 3.11+
+            for category, value in self.limits.sqlite_limits.items():
+                self.previous[category] = self.conn.setlimit(category, value)
+
+    def restart(self) -> None:
+        """Give the query its whole timeout again from now"""
+        if self.limits is not None and self.limits.timeout is not None:
+            self.deadline = time.monotonic() + self.limits.timeout
+
+    def stop(self) -> None:
+        """Take the guards off the connection, which may go back to the pool afterwards"""
+        if self.deadline is not None:
+            self.conn.set_progress_handler(None, 0)
+            self.deadline = None
+        for category, value in self.previous.items():
+            self.conn.setlimit(category, value)
+        self.previous.clear()
+
+    @contextlib.contextmanager
+    def lock(self, path: str, shared: bool = False):
+        """Hold the lock of path (LOCKS.hold) for the duration of the with block, waiting for it at most until the deadline"""
+        timeout = None  # the LOCKS timeout
+        if self.deadline is not None:
+            timeout = max(self.deadline - time.monotonic(), 0.0)
+            if database.locks.LOCKS.timeout is not None:
+                timeout = min(timeout, database.locks.LOCKS.timeout)
+        with contextlib.ExitStack() as stack:
+            try:
+                stack.enter_context(database.locks.LOCKS.hold(path, shared=shared, timeout=timeout))
+            except Exception:
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self.expired = True
+                raise
+            yield
+
+    def progress(self) -> int:
+        if time.monotonic() > self.deadline:
+            self.expired = True
+            return 1  # interrupts the query
+        return 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+
+TIERS = {tier: QueryLimits(**{key: value for key, value in limits.items() if key in QueryLimits.KEYS}) for tier, limits in database.settings.TOKEN_TIERS.items()}
+if 'default' not in TIERS:
+    TIERS['default'] = QueryLimits()
@@ -0,0 +1,148 @@
+import contextlib
+import threading
+import time
+import weakref
+import database.settings
+import database.metrics
+
+READ_STATEMENTS = ('SELECT', 'EXPLAIN', 'VALUES')
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'END', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+
+def is_read(query: str) -> bool:
+    """Return whether the statement can only read (anything not recognized is treated as a write)"""
+    words = query.lstrip(" \t\r\n(").split(None, 1)
+    return bool(words) and words[0].upper() in READ_STATEMENTS
+
+
+def controls_transaction(query: str) -> bool:
+    """Return whether the statement begins or ends a transaction or a savepoint"""
+    words = query.lstrip(" \t\r\n").split(None, 1)
+    return bool(words) and words[0].upper().rstrip(';') in TRANSACTION_STATEMENTS
+
+
+class ReadWriteLock:
+    """
+    Many readers or a single writer
+    Waiting writers block new readers, so a steady stream of SELECTs can't starve them
+    The writer may re-acquire the lock (shared or not) while holding it
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    def acquire(self, shared: bool, timeout: float or None = None) -> bool:
+        """Return whether the lock was acquired before timeout (None waits forever)"""
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+                return True
+            if shared:
+                if not self.condition.wait_for(lambda: self.writer is None and not self.waiting_writers, timeout):
+                    return False
+                self.readers += 1
+                return True
+            self.waiting_writers += 1
+            acquired = self.condition.wait_for(lambda: self.writer is None and not self.readers, timeout)
+            self.waiting_writers -= 1
+            if not acquired:
+                # readers held back by this writer may go on
+                self.condition.notify_all()
+                return False
+            self.writer = me
+            self.writer_depth = 1
+            return True
+
+    def release(self) -> None:
+        with self.condition:
+            if self.writer == threading.get_ident():
+                self.writer_depth -= 1
+                if self.writer_depth:
+                    return
+                self.writer = None
+            else:
+                self.readers -= 1
+            self.condition.notify_all()
+
+
+class LockManager:
+    """One ReadWriteLock per database path, created on demand and dropped once nobody references it"""
+
+    def __init__(self, timeout: float or None = None):
+        """
+        :param timeout: default seconds to wait for a lock (None waits forever)
+        """
+        self.timeout = timeout
+        self.mutex = threading.Lock()
+        self.locks = weakref.WeakValueDictionary()
+        self.waits = {}  # database label (database.metrics.database_label) -> [acquisitions, total wait seconds, max wait seconds, timeouts]
+
+    def get(self, path: str) -> ReadWriteLock:
+        with self.mutex:
+            lock = self.locks.get(path)
+            if lock is None:
+                lock = self.locks[path] = ReadWriteLock()
+            return lock
+
+    @contextlib.contextmanager
+    def hold(self, path: str, shared: bool = False, timeout: float or None = None):
+        """
+        Hold the lock of path for the duration of the with block
+        :param shared: allow other shared holders at the same time (readers)
+        :param timeout: seconds to wait, defaults to the manager timeout
+        :raises Exception: if the lock could not be acquired in time
+        """
+        lock = self.get(path)
+        start = time.perf_counter()
+        acquired = lock.acquire(shared, self.timeout if timeout is None else timeout)
+        self._record(path, time.perf_counter() - start, acquired)
+        if not acquired:
+            raise Exception("Timed out waiting for the database lock")
+        try:
+            yield lock
+        finally:
+            lock.release()
+
+    def stats(self) -> dict:
+        """Return lock wait statistics per database, the least recently used ones together as 'other' (METRICS_MAX_DATABASES)"""
+        with self.mutex:
+            return {
+                label: {'acquisitions': count, 'wait_total': total, 'wait_max': longest, 'timeouts': timeouts}
+                for label, (count, total, longest, timeouts) in self.waits.items()
+            }
+
+    def fold(self, kept: set) -> None:
+        """Merge the statistics of the databases not in kept into the 'other' ones (see database.metrics.DatabaseLabels)"""
+        with self.mutex:
+            for label in [label for label in self.waits if label not in kept and label != database.metrics.OTHER]:
+                count, total, longest, timeouts = self.waits.pop(label)
+                other = self.waits.setdefault(database.metrics.OTHER, [0, 0.0, 0.0, 0])
+                other[0] += count
+                other[1] += total
+                other[2] = max(other[2], longest)
+                other[3] += timeouts
+
+    def _record(self, path: str, waited: float, acquired: bool) -> None:
+        label = database.metrics.database_label(path)
+        database.metrics.LOCK_WAIT_SECONDS.observe(waited, label)
+        if not acquired:
+            database.metrics.LOCK_TIMEOUTS.inc(label)
+        with self.mutex:
+            stats = self.waits.get(label)
+            if stats is None:
+                stats = self.waits[label] = [0, 0.0, 0.0, 0]
+            if acquired:
+                stats[0] += 1
+            else:
+                stats[3] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+
+
+LOCKS = LockManager(timeout=database.settings.LOCK_TIMEOUT)
+database.metrics.DATABASES.folds.append(LOCKS.fold)
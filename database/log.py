@@ -0,0 +1,103 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import reprlib
+import sys
+import database.settings
+
+PREVIEW = reprlib.Repr()
+PREVIEW.maxlist = 5
+PREVIEW.maxdict = 10
+PREVIEW.maxstring = 80
+PREVIEW.maxother = 80
+PREVIEW.maxlevel = 3
+
+
+def preview(value, limit: int or None = None) -> str:
+    """Return a short repr of value (long lists and strings are cut) for log messages"""
+    text = PREVIEW.repr(value)
+    limit = database.settings.LOG_PREVIEW_LENGTH if limit is None else limit
+    if len(text) > limit:
+        text = text[:limit] + "..."
+    return text
+
+
+class JSONFormatter(logging.Formatter):
+    """One json object per record: time, level, logger, message and any extra given to the log call"""
+
+    RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update({k: v for k, v in vars(record).items() if k not in self.RESERVED})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a background listener without ever blocking the caller
+    The message is rendered when the record is queued, so the queue doesn't keep its arguments (e.g. responses and their results) alive
+    The rest of the formatting is left to the listener thread, and records are dropped (and counted) when the queue is full
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback holds the frames of the caller, and their locals
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+listener = None
+
+
+def setup(level: str or None = None, json_format: bool or None = None) -> None:
+    """
+    Send every log record through a queue to a single stderr writer thread, done once per process
+    :param level: logging level name, defaults to LOG_LEVEL
+    :param json_format: write json records instead of text lines, defaults to LOG_JSON
+    """
+    global listener
+    if listener is not None:
+        return
+    level = database.settings.LOG_LEVEL if level is None else level
+    json_format = database.settings.LOG_JSON if json_format is None else json_format
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if json_format:
+        stream_handler.setFormatter(JSONFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=database.settings.LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
@@ -0,0 +1,237 @@
+import bisect
+import collections
+import os
+import threading
+import time
+import database.settings
+
+# when False, timers are a shared no-op and observations return at once
+ENABLED = database.settings.METRICS_ENABLED
+
+# upper bounds (seconds) of the histogram buckets, from 100µs to 10s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = []  # every metric, in the order they are rendered
+
+ROOT_PREFIX = os.path.join(database.settings.ROOT_DATABASE_PATH, '')
+OTHER = 'other'  # label value of the databases without one of their own
+
+
+class DatabaseLabels:
+    """
+    Label values of the per database metrics: the max_size databases used most recently have their own, the others share OTHER
+    The series of a database pushed out are folded into the OTHER ones, so totals stay right while the series are bounded
+    """
+
+    def __init__(self, max_size: int):
+        assert type(max_size) is int and max_size > 0
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.labels = collections.OrderedDict()  # path -> label, least recently used first
+        self.folds = []  # functions given the labels kept, they fold the series of any other label into OTHER
+
+    @staticmethod
+    def name(path: str) -> str:
+        """root, or the folder and file of a tenant database"""
+        if path.startswith(ROOT_PREFIX):
+            return 'root'
+        return os.path.relpath(path, database.settings.USER_DATABASE_PATH).replace(os.sep, '/')
+
+    def label(self, path: str) -> str:
+        with self.lock:
+            label = self.labels.get(path)
+            if label is not None:
+                self.labels.move_to_end(path)
+                return label
+            label = self.labels[path] = self.name(path)
+            if len(self.labels) <= self.max_size:
+                return label
+            self.labels.popitem(last=False)
+            kept = set(self.labels.values())
+        for fold in self.folds:
+            fold(kept)
+        return label
+
+
+def label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class NullTimer:
+    """Timer of a disabled metric"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    """Observes the seconds its with block took"""
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: 'Histogram', labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets (a Prometheus histogram)"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        """
+        :param name: metric name
+        :param help_text: description of the metric
+        :param labels: names of the labels, every observation gives a value for each
+        :param buckets: upper bounds of the buckets, increasing
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [count per bucket (+Inf last), sum, count]
+        METRICS.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        """Return a context manager observing the seconds its with block takes"""
+        return Timer(self, labels) if ENABLED else NULL_TIMER
+
+    def fold(self, index: int, kept: set) -> None:
+        """Merge the series whose label at index isn't in kept into the OTHER ones (see DatabaseLabels)"""
+        with self.lock:
+            for labels in [labels for labels in self.series if labels[index] not in kept and labels[index] != OTHER]:
+                counts, total, count = self.series.pop(labels)
+                other = labels[:index] + (OTHER,) + labels[index + 1:]
+                series = self.series.get(other)
+                if series is None:
+                    series = self.series[other] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, amount in zip(self.buckets + ('+Inf',), counts):
+                cumulative += amount
+                le = 'le="{}"'.format(bound)
+                lines.append(f"{self.name}_bucket{label_text(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{label_text(self.labels, labels)} {count}")
+        return lines
+
+
+class Counter:
+    """Value that only goes up (a Prometheus counter)"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> value
+        METRICS.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        if not ENABLED:
+            return
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def fold(self, index: int, kept: set) -> None:
+        """Merge the series whose label at index isn't in kept into the OTHER ones (see DatabaseLabels)"""
+        with self.lock:
+            for labels in [labels for labels in self.series if labels[index] not in kept and labels[index] != OTHER]:
+                other = labels[:index] + (OTHER,) + labels[index + 1:]
+                self.series[other] = self.series.get(other, 0) + self.series.pop(labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = list(self.series.items())
+        lines.extend([f"{self.name}{label_text(self.labels, labels)} {value}" for labels, value in series])
+        return lines
+
+
+class Collected:
+    """Metric read from its owner when rendered, e.g. the counters kept by the pool or the usage writer"""
+
+    def __init__(self, name: str, help_text: str, metric_type: str, labels: tuple, collect):
+        """
+        :param metric_type: 'gauge' or 'counter'
+        :param collect: function returning {label values: value}
+        """
+        assert metric_type in ('gauge', 'counter')
+
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labels = labels
+        self.collect = collect
+        METRICS.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend([f"{self.name}{label_text(self.labels, labels)} {value}" for labels, value in self.collect().items()])
+        return lines
+
+
+def render() -> str:
+    """Return every metric in the Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+AUTH_SECONDS = Histogram("api_auth_seconds", "Seconds taken to authenticate a token")
+POOL_ACQUIRE_SECONDS = Histogram("pool_acquire_seconds", "Seconds taken to check out a pooled connection (opening it included)")
+LOCK_WAIT_SECONDS = Histogram("lock_wait_seconds", "Seconds waited for the lock of a database", ('database',))
+LOCK_TIMEOUTS = Counter("lock_timeouts_total", "Lock waits that timed out", ('database',))
+QUERY_EXECUTE_SECONDS = Histogram("query_execute_seconds", "Seconds taken by cursor.execute of a tenant query")
+QUERY_FETCH_SECONDS = Histogram("query_fetch_seconds", "Seconds taken to fetch the rows of a tenant query")
+QUERIES = Counter("database_queries_total", "Tenant queries by database and status", ('database', 'status'))
+EXECUTOR_SECONDS = Histogram("executor_seconds", "Seconds from sending a query to a worker process to having its response back")
+SERIALIZATION_SECONDS = Histogram("response_serialization_seconds", "Seconds taken to serialize an API response")
+USAGE_ENQUEUE_SECONDS = Histogram("usage_enqueue_seconds", "Seconds taken to queue the usage record of a request")
+
+DATABASES = DatabaseLabels(database.settings.METRICS_MAX_DATABASES)
+for metric in (LOCK_WAIT_SECONDS, LOCK_TIMEOUTS, QUERIES):
+    DATABASES.folds.append(lambda kept, metric=metric: metric.fold(0, kept))
+
+
+def database_label(path: str) -> str:
+    """Return the label value of the database at path, see DatabaseLabels"""
+    return DATABASES.label(path)
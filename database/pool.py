@@ -0,0 +1,234 @@
+import collections
+import os
+import re
+import sqlite3
+import threading
+import time
+import database.settings
+import database.metrics
+
+
+class PoolTimeout(Exception):
+    """No connection to a database became available within the acquire timeout of the pool, the server is too busy"""
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that knows which database file it belongs to and when it was last used"""
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.path = path
+        self.last_used = time.monotonic()
+        self.journal_mode = None
+
+    def apply_pragmas(self, pragmas: dict) -> None:
+        """
+        Configure the connection, done once when it is opened
+        :param pragmas: PRAGMA name -> value, e.g. {"journal_mode": "WAL", "synchronous": "NORMAL"}
+        """
+        for name, value in pragmas.items():
+            if not re.fullmatch(r"\w+", name) or not re.fullmatch(r"-?\w+", str(value)):
+                raise Exception(f"Invalid PRAGMA {name} = {value}")
+            self.execute(f"PRAGMA {name} = {value}").fetchall()
+        self.journal_mode = self.execute("PRAGMA journal_mode").fetchone()[0].lower()
+
+
+class ConnectionPool:
+    """
+    Long-lived sqlite3 connections keyed by database path
+
+    Connections are checked out for the duration of one transaction (one RootDatabase/UserDatabase context)
+    and handed back afterwards instead of being closed.
+    Idle connections are evicted least recently used first, either when they are idle for too long
+    or when a new database needs room under the global limit.
+    """
+
+    def __init__(self, *, max_per_database: int, max_total: int, idle_timeout: float, health_check_interval: float, acquire_timeout: float, cached_statements: int = 128):
+        """
+        :param max_per_database: maximum amount of open connections for a single database file
+        :param max_total: maximum amount of open connections for all database files together
+        :param idle_timeout: seconds an idle connection is kept open
+        :param health_check_interval: seconds of idleness after which a connection is checked before being reused
+        :param acquire_timeout: seconds to wait for a free connection before giving up
+        :param cached_statements: size of the compiled statement cache of each connection
+        """
+        assert type(max_per_database) is int and max_per_database > 0
+        assert type(max_total) is int and max_total >= max_per_database
+
+        self.max_per_database = max_per_database
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.cached_statements = cached_statements
+        self.condition = threading.Condition()
+        self.idle = {}  # path -> idle connections, most recently released last
+        self.lru = collections.OrderedDict()  # every idle connection, least recently released first
+        self.opened = collections.Counter()  # path -> open connections (idle or checked out)
+        self.total = 0
+
+    def acquire(self, path: str, pragmas: dict or None = None) -> PooledConnection:
+        """
+        Check out a connection to the database at path, opening one if needed
+        :param pragmas: PRAGMA profile applied when a new connection is opened
+        :raises PoolTimeout: if no connection becomes available within acquire_timeout
+        """
+        with database.metrics.POOL_ACQUIRE_SECONDS.time():
+            return self._acquire(path, pragmas)
+
+    def _acquire(self, path: str, pragmas: dict or None) -> PooledConnection:
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            conn, evicted = self._checkout(path, deadline)
+            for old_conn in evicted:
+                old_conn.close()
+            if conn is None:
+                return self._connect(path, pragmas or {})
+            if time.monotonic() - conn.last_used < self.health_check_interval or self._healthy(conn):
+                return conn
+            self._forget(conn)
+
+    def release(self, conn: PooledConnection, discard: bool = False) -> None:
+        """
+        Give a connection back to the pool
+        :param discard: close the connection instead of keeping it
+        """
+        if not discard and conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                discard = True
+        if discard:
+            self._forget(conn)
+            return
+        now = time.monotonic()
+        conn.last_used = now
+        with self.condition:
+            self.idle.setdefault(conn.path, []).append(conn)
+            self.lru[conn] = None
+            evicted = self._evict_expired(now)
+            self.condition.notify_all()
+        for old_conn in evicted:
+            old_conn.close()
+
+    def close_all(self) -> None:
+        """Close every idle connection (checked out connections are closed when released with discard)"""
+        with self.condition:
+            evicted = list(self.lru)
+            for conn in evicted:
+                self._remove_idle(conn)
+            self.condition.notify_all()
+        for conn in evicted:
+            conn.close()
+
+    def stats(self) -> dict:
+        """Return counters describing the current pool usage"""
+        with self.condition:
+            return {
+                'open': self.total,
+                'idle': len(self.lru),
+                'databases': len(self.opened),
+            }
+
+    def _checkout(self, path: str, deadline: float):
+        """
+        Wait until path has an idle connection or room for a new one
+        :return: (idle connection or None if one must be opened, connections evicted to make room)
+        """
+        evicted = []
+        with self.condition:
+            while True:
+                evicted.extend(self._evict_expired(time.monotonic()))
+                conns = self.idle.get(path)
+                if conns:
+                    conn = conns[-1]
+                    self._take_idle(conn)
+                    return conn, evicted
+                if self.opened[path] < self.max_per_database:
+                    if self.total >= self.max_total and self.lru:
+                        # make room by closing the least recently used idle connection of any database
+                        evicted.append(self._remove_idle(next(iter(self.lru))))
+                    if self.total < self.max_total:
+                        self.opened[path] += 1
+                        self.total += 1
+                        return None, evicted
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Timed out waiting for a connection to {path}")
+                self.condition.wait(remaining)
+
+    def _connect(self, path: str, pragmas: dict) -> PooledConnection:
+        try:
+            os.makedirs(os.path.split(path)[0], exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False, cached_statements=self.cached_statements, factory=PooledConnection)
+        except Exception:
+            self._forget_slot(path)
+            raise
+        try:
+            conn.apply_pragmas(pragmas)
+        except Exception:
+            self._forget(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _healthy(conn: PooledConnection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _forget(self, conn: PooledConnection) -> None:
+        """Close a checked out connection and free its slot"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._forget_slot(conn.path)
+
+    def _forget_slot(self, path: str) -> None:
+        with self.condition:
+            self._decrement(path)
+            self.condition.notify_all()
+
+    def _evict_expired(self, now: float) -> list:
+        """Remove connections idle for longer than idle_timeout (caller holds the condition)"""
+        evicted = []
+        while self.lru:
+            conn = next(iter(self.lru))
+            if now - conn.last_used < self.idle_timeout:
+                break
+            evicted.append(self._remove_idle(conn))
+        return evicted
+
+    def _take_idle(self, conn: PooledConnection) -> None:
+        """Detach an idle connection from the idle structures (caller holds the condition)"""
+        del self.lru[conn]
+        conns = self.idle[conn.path]
+        conns.remove(conn)
+        if not conns:
+            del self.idle[conn.path]
+
+    def _remove_idle(self, conn: PooledConnection) -> PooledConnection:
+        """Detach an idle connection and free its slot, the caller closes it (caller holds the condition)"""
+        self._take_idle(conn)
+        self._decrement(conn.path)
+        return conn
+
+    def _decrement(self, path: str) -> None:
+        self.opened[path] -= 1
+        if self.opened[path] <= 0:
+            del self.opened[path]
+        self.total -= 1
+
+
+POOL = ConnectionPool(
+    max_per_database=database.settings.POOL_MAX_CONNECTIONS_PER_DATABASE,
+    max_total=database.settings.POOL_MAX_CONNECTIONS,
+    idle_timeout=database.settings.POOL_IDLE_TIMEOUT,
+    health_check_interval=database.settings.POOL_HEALTH_CHECK_INTERVAL,
+    acquire_timeout=database.settings.POOL_ACQUIRE_TIMEOUT,
+    cached_statements=database.settings.SQLITE_CACHED_STATEMENTS,
+)
+database.metrics.Collected("pool_connections", "Pooled connections by state", 'gauge', ('state',), lambda: {(state,): value for state, value in POOL.stats().items()})
@@ -1,39 +1,58 @@
 import json
+import logging
+import database.log
+
+logger = logging.getLogger(__name__)
 
 
 class DatabaseResponse:
     """Base class for all responses"""
 
-    def __init__(self, status: int, query: str, results: list or None = None, lastrowid: int or None = None, error_message: str or None = None):
+    def __init__(self, status: int, query: str, results: list or None = None, lastrowid: int or None = None, error_message: str or None = None, columns: list or None = None):
         """
         :param status: Status code of the query
         :param query: query requested to database
         :param results: database data answer (if select)
         :param lastrowid: database lastrowid (if insert)
         :param error_message: database error (if any)
+        :param columns: names of the result columns (if the query returns rows)
         """
         assert type(status) == int
         assert type(query) is str
         assert type(results) is list or results is None
         assert type(lastrowid) is int or lastrowid is None
         assert type(error_message) is str or error_message is None
+        assert type(columns) is list or columns is None
 
         self.status = status
         self.query = query
         self.error_message = error_message
         self.results = results
         self.lastrowid = lastrowid
-        if type(self) is DatabaseResponse:
-            print(self)
+        self.columns = columns
+        self.truncated = False  # whether rows were left out of results, see QueryLimits.max_rows
+        self.limit = None  # {'name': name, 'value': value} of the limit that stopped the query (if any)
+        self.cursor = None  # continuation token of the next page of a paged query (page_size), None once every row was sent
+        self._rows = None if results is None else len(results)  # amount of rows, results may be laid out by column
+        self._results_json = None  # results already serialized, set by the result cache
+        self._duration = None  # seconds the database took, set by whoever executed the query and kept out of the json
+        logger.debug("%r", self)
 
     @classmethod
-    def good(cls, query: str, results: list or None = None, lastrowid: int or None = None):
-        return cls(200, query, results, lastrowid)
+    def good(cls, query: str, results: list or None = None, lastrowid: int or None = None, columns: list or None = None):
+        return cls(200, query, results, lastrowid, columns=columns)
 
     @classmethod
     def bad(cls, query: str, results: list or None = None, lastrowid: int or None = None, error_message: str or None = None):
         return cls(400, query, results, lastrowid, error_message)
 
+    @classmethod
+    def limited(cls, query: str, limit: str, value, error_message: str):
+        """Response of a query stopped by one of its limits (QueryLimits)"""
+        response = cls.bad(query, error_message=error_message)
+        response.limit = {'name': limit, 'value': value}
+        return response
+
     @property
     def ok(self) -> bool:
         """Retrun whether the request succeeded"""
@@ -41,11 +60,17 @@ class DatabaseResponse:
 
     def __repr__(self) -> str:
         """Representation of the class for debugging"""
-        return f"""<{type(self).__name__} {self.status} || {'Error: "' + str(self.error_message) + '"' if self.error_message else 'OK'} | QUERY: "{self.query}" | LRID: "{self.lastrowid}" | Results: {self.results}>"""
+        return f"""<{type(self).__name__} {self.status} || {'Error: "' + str(self.error_message) + '"' if self.error_message else 'OK'} | QUERY: "{self.query}" | LRID: "{self.lastrowid}" | Results: {database.log.preview(self.results)}>"""
+
+    def rows(self) -> list:
+        """Return the results as a list, deserialized again if they were only kept serialized"""
+        if self.results is None and self._results_json is not None:
+            return json.loads(self._results_json)
+        return self.results or []
 
     def json_object(self):
         """Return json object representation of the class"""
-        return self.__dict__
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
 
     def json(self) -> str:
         """Return json representation of the class"""
@@ -1,17 +1,19 @@
 import sqlite3
-import threading
 import os
+import re
 import database.settings
+import database.pool
+import database.locks
 import database.root.response
+import database.root.schema
 import database.root.types.user
 import database.root.types.token
 import database.root.types.use
 import datetime
+import json
 
 
 class RootDatabase:
-    lock = threading.RLock()
-
     def __init__(self, database_name: str = 'root', autocommit: bool = True, autorollback: bool = True):
         """
         :param database_name: name of the database
@@ -25,17 +27,18 @@ class RootDatabase:
         path = os.path.join(database.settings.ROOT_DATABASE_PATH, database_name)
         if os.path.splitext(path)[1] != ".db":
             path += ".db"
-        os.makedirs(os.path.split(path)[0], exist_ok=True)
         self.path = path
         self.autocommit = autocommit
         self.autorollback = autorollback
-        self.conn = sqlite3.connect(path, check_same_thread=False)
-        self.conn.row_factory = lambda c, r: dict([(col[0], r[idx]) for idx, col in enumerate(c.description)])
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("PRAGMA foreign_keys = ON;")
-        with open(database.settings.ROOT_TABLES_SCRIPT_PATH) as f:
-            self.cursor.executescript(f.read())
-        self.conn.commit()
+        self.callbacks = []  # called once the transaction ended, see after_commit
+        self.conn = database.pool.POOL.acquire(path, database.settings.ROOT_PRAGMAS)
+        try:
+            database.root.schema.ensure(self.conn, path)
+            self.conn.row_factory = lambda c, r: dict([(col[0], r[idx]) for idx, col in enumerate(c.description)])
+            self.cursor = self.conn.cursor()
+        except Exception:
+            database.pool.POOL.release(self.conn, discard=True)
+            raise
 
     def __enter__(self):
         return self
@@ -43,36 +46,79 @@ class RootDatabase:
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         Closing context manager, verify if rollsback or commit and if they are enabled
+        The connection goes back to the pool instead of being closed, then the after_commit callbacks run
         Always raises (return False)
         """
-        if exc_type:
-            # something went wrong
-            if self.autorollback:
-                self.conn.rollback()
-        else:
-            # all good
-            if self.autocommit:
-                self.conn.commit()
-        self.conn.close()
+        try:
+            try:
+                if exc_type:
+                    # something went wrong
+                    if self.autorollback:
+                        self.conn.rollback()
+                else:
+                    # all good
+                    if self.autocommit:
+                        self.conn.commit()
+            except sqlite3.Error:
+                database.pool.POOL.release(self.conn, discard=True)
+                raise
+            database.pool.POOL.release(self.conn)
+        finally:
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
         return False  # raise exception
 
+    def after_commit(self, callback) -> None:
+        """
+        Call callback once the transaction of this block is over (committed, or rolled back), e.g. to forget what caches read before the change
+        Running it before the commit would let a concurrent reader cache the old rows again
+        """
+        self.callbacks.append(callback)
+
     @staticmethod
     def make_query_from_dict(joinwith: str, **kwargs):
-        return joinwith.join([f"`{k}` = '{v}'" for k, v in kwargs.items()])
+        """
+        Return ("`column` = ? <joinwith> ...", values) to be executed as a parameterized query
+        The text only depends on the column names, so the compiled statement is reused by sqlite's statement cache
+        """
+        for column in kwargs:
+            if not re.fullmatch(r"\w+", column):
+                raise Exception(f"Invalid column: {column}")
+        return joinwith.join([f"`{k}` = ?" for k in kwargs]), tuple(kwargs.values())
+
+    def shared(self, query: str) -> bool:
+        """Return whether query may run alongside other readers of this database (only in WAL mode)"""
+        return self.conn.journal_mode == "wal" and database.locks.is_read(query)
 
-    def execute(self, query: str):
+    def execute(self, query: str, parameters: tuple or dict = ()):
         """
         Generic execute statement for ONE query
+        :param parameters: values bound to the ? (or :name) placeholders of query
         :rtype: database.root.response.RootDatabaseResponse
         """
 
-        with self.lock:
-            try:
-                self.cursor.execute(query)
-            except Exception as e:
-                return database.root.response.RootDatabaseResponse.bad(query, error_message=str(e))
-            else:
-                return database.root.response.RootDatabaseResponse.good(query, results=self.cursor.fetchall(), lastrowid=self.cursor.lastrowid)
+        try:
+            with database.locks.LOCKS.hold(self.path, shared=self.shared(query)):
+                self.cursor.execute(query, parameters)
+                results = self.cursor.fetchall()
+        except Exception as e:
+            return database.root.response.RootDatabaseResponse.bad(query, error_message=str(e))
+        else:
+            return database.root.response.RootDatabaseResponse.good(query, results=results, lastrowid=self.cursor.lastrowid)
+
+    def executemany(self, query: str, parameters: list):
+        """
+        Generic execute statement for ONE query repeated with every item of parameters
+        :rtype: database.root.response.RootDatabaseResponse
+        """
+        try:
+            with database.locks.LOCKS.hold(self.path):
+                self.cursor.executemany(query, parameters)
+        except Exception as e:
+            return database.root.response.RootDatabaseResponse.bad(query, error_message=str(e))
+        else:
+            return database.root.response.RootDatabaseResponse.good(query, lastrowid=self.cursor.lastrowid)
 
     def executescript(self, script: str):
         """
@@ -80,13 +126,13 @@ class RootDatabase:
         It does NOT provide any information other than error_message (useless in 'select' query)
         :rtype: database.root.response.RootDatabaseResponse
         """
-        with self.lock:
-            try:
+        try:
+            with database.locks.LOCKS.hold(self.path):
                 self.cursor.executescript(script)
-            except Exception as e:
-                return database.root.response.RootDatabaseResponse.bad(script, error_message=str(e))
-            else:
-                return database.root.response.RootDatabaseResponse.good(script)
+        except Exception as e:
+            return database.root.response.RootDatabaseResponse.bad(script, error_message=str(e))
+        else:
+            return database.root.response.RootDatabaseResponse.good(script)
 
     def insert_user(self, *, user_fullname: str, user_email: str, user_password: str):
         """
@@ -95,9 +141,9 @@ class RootDatabase:
         :rtype: database.root.types.user.User
         """
         user_creation = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
-        response = self.execute(f"INSERT INTO user (user_fullname, user_email, user_password, user_creation) VALUES ('{user_fullname}', '{user_email}', '{user_password}', '{user_creation}')")
+        response = self.execute("INSERT INTO user (user_fullname, user_email, user_password, user_creation) VALUES (?, ?, ?, ?)", (user_fullname, user_email, user_password, user_creation))
         if response.ok:
-            response = self.execute(f"SELECT * FROM user WHERE user_email='{user_email}'")
+            response = self.execute("SELECT * FROM user WHERE user_email = ?", (user_email,))
             if response.ok:
                 if response.results:
                     return database.root.types.user.User.from_dict(response.results[0])
@@ -108,7 +154,8 @@ class RootDatabase:
         :return: User
         :rtype: database.root.types.user.User
         """
-        response = self.execute(f"SELECT * FROM user WHERE {self.make_query_from_dict(' and ', **kwargs)}")
+        where, parameters = self.make_query_from_dict(' and ', **kwargs)
+        response = self.execute(f"SELECT * FROM user WHERE {where}", parameters)
         if response.ok:
             if response.results:
                 return database.root.types.user.User.from_dict(response.results[0])
@@ -123,20 +170,17 @@ class RootDatabase:
         Warning: user_id ignored
         :rtype
         """
-        current_dbname = f"{user_id}/{token_database_name}"
-        response = self.execute("SELECT user_id || '/' || token_database_name as dbname FROM token")
+        token_creation = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
+        response = self.execute("INSERT INTO token (user_id, token_token, token_database_name, token_creation) VALUES (?, ?, ?, ?)", (user_id, token_token, token_database_name, token_creation))
         if response.ok:
-            for dbname_dict in response.results:
-                dbname = dbname_dict['dbname']
-                if current_dbname == dbname:
-                    raise Exception("Database already exists")
-            token_creation = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
-            response = self.execute(f"INSERT INTO token (user_id, token_token, token_database_name, token_creation) VALUES ('{user_id}', '{token_token}','{token_database_name}', '{token_creation}')")
+            self.after_commit(lambda: database.root.types.token.Token.invalidate(token_token=token_token))
+            token_id = response.lastrowid
+            response = self.execute("SELECT * FROM token WHERE token_id = ?", (token_id,))
             if response.ok:
-                token_id = response.lastrowid
-                response = self.execute(f"SELECT * FROM token WHERE token_id = '{token_id}'")
-                if response.ok:
-                    return database.root.types.token.Token.from_dict(response.results[0])
+                return database.root.types.token.Token.from_dict(response.results[0])
+        elif response.error_message.startswith("UNIQUE constraint failed: token.user_id, token.token_database_name"):
+            # the unique index on (user_id, token_database_name) does the duplicate check
+            raise Exception("Database already exists")
         raise Exception("Could not add token")
 
     def select_tokens(self, **kwargs):
@@ -144,7 +188,8 @@ class RootDatabase:
         :return: list of tokens match according to kwargs
         :rtype: list[database.root.types.token.Token]
         """
-        response = self.execute(f"SELECT * FROM token WHERE {self.make_query_from_dict(' and ', **kwargs)}")
+        where, parameters = self.make_query_from_dict(' and ', **kwargs)
+        response = self.execute(f"SELECT * FROM token WHERE {where}", parameters)
         results = []
         if response.ok:
             for token_dict in response.results:
@@ -156,7 +201,9 @@ class RootDatabase:
         :return: bool whether the operation has gone right
         :rtype: None
         """
-        response = self.execute(f"UPDATE token SET {self.make_query_from_dict(', ', **kwargs)} WHERE token_id='{token_id}'")
+        assignments, parameters = self.make_query_from_dict(', ', **kwargs)
+        response = self.execute(f"UPDATE token SET {assignments} WHERE token_id = ?", parameters + (token_id,))
+        self.after_commit(lambda: database.root.types.token.Token.invalidate(token_id=token_id, token_token=kwargs.get('token_token')))
         if not response.ok:
             raise Exception("Could not update token")
 
@@ -167,21 +214,148 @@ class RootDatabase:
         :rtype: bool
         """
         use_creation = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
-        response = self.execute(f"INSERT INTO use (token_id, use_data, use_creation) VALUES ((SELECT token_id FROM token WHERE token_token = '{token_token}'), '{use_data}', '{use_creation}')")
+        return self.insert_uses([(token_token, use_data, use_creation)])
+
+    def insert_uses(self, uses: list) -> bool:
+        """
+        Insert many uses in one statement, uses whose token doesn't exist are skipped
+        The use_rollup counters of the uses are updated as well
+        :param uses: list of (token_token, use_data, use_creation)
+        :return: whether the operation has gone right
+        """
+        response = self.executemany("INSERT INTO use (token_id, use_data, use_creation) SELECT token_id, ?2, ?3 FROM token WHERE token_token = ?1", uses)
+        if not response.ok:
+            return False
+        rollups = {}
+        for token_token, use_data, use_creation in uses:
+            data = json.loads(use_data)
+            for period, start in self.rollup_starts(use_creation).items():
+                counters = rollups.setdefault((token_token, period, start), [0, 0, 0])
+                counters[0] += 1
+                counters[1] += self.use_failed(data)
+                counters[2] += data.get('bytes') or 0
+        response = self.executemany("""
+            INSERT INTO use_rollup (token_id, rollup_period, rollup_start, rollup_requests, rollup_errors, rollup_bytes)
+            SELECT token_id, ?2, ?3, ?4, ?5, ?6 FROM token WHERE token_token = ?1
+            ON CONFLICT (token_id, rollup_period, rollup_start) DO UPDATE SET
+                rollup_requests = rollup_requests + excluded.rollup_requests,
+                rollup_errors = rollup_errors + excluded.rollup_errors,
+                rollup_bytes = rollup_bytes + excluded.rollup_bytes
+        """, [key + tuple(counters) for key, counters in rollups.items()])
+        if not response.ok:
+            return False
+        # the minute rollups are only read for the last hour (Token.get_use_summary)
+        cutoff = (datetime.datetime.now() - datetime.timedelta(hours=1)).strftime(database.settings.DATETIME_FORMAT)
+        response = self.execute("DELETE FROM use_rollup WHERE rollup_period = 'minute' AND rollup_start < ?", (cutoff,))
         return response.ok
 
+    def add_token_quotas(self, quotas: dict) -> dict:
+        """
+        Add requests to the daily usage of tokens
+        :param quotas: {(token_id, quota_day): requests}
+        :return: {(token_id, quota_day): requests of the day in total}
+        """
+        totals = {}
+        for (token_id, quota_day), requests in quotas.items():
+            response = self.execute("""
+                INSERT INTO token_quota (token_id, quota_day, quota_requests) VALUES (?, ?, ?)
+                ON CONFLICT (token_id, quota_day) DO UPDATE SET quota_requests = quota_requests + excluded.quota_requests
+                RETURNING quota_requests
+            """, (token_id, quota_day, requests))
+            if not response.ok:
+                raise Exception("Could not add token quotas")
+            totals[(token_id, quota_day)] = response.results[0]['quota_requests']
+        return totals
+
+    def insert_mail(self, *, mail_recipient: str, mail_subject: str, mail_body: str) -> int:
+        """
+        Queue a mail in the outbox, the mail dispatcher sends it
+        :return: mail_id
+        """
+        now = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
+        response = self.execute("INSERT INTO mail (mail_recipient, mail_subject, mail_body, mail_creation, mail_next_attempt) VALUES (?, ?, ?, ?, ?)",
+                                (mail_recipient, mail_subject, mail_body, now, now))
+        if not response.ok:
+            raise Exception("Could not add mail")
+        return response.lastrowid
+
+    def claim_mails(self, *, limit: int, lease: float) -> list:
+        """
+        Take the pending mails due to be sent, oldest first
+        Their attempt is counted and their next attempt put lease seconds away, so other dispatchers leave them alone meanwhile
+        and they are tried again if this one never reports back
+        :return: list of mail rows (dict)
+        """
+        now = datetime.datetime.now()
+        response = self.execute("""
+            UPDATE mail SET mail_attempts = mail_attempts + 1, mail_next_attempt = ?
+            WHERE mail_id IN (SELECT mail_id FROM mail WHERE mail_status = 'pending' AND mail_next_attempt <= ? ORDER BY mail_id LIMIT ?)
+            RETURNING *
+        """, ((now + datetime.timedelta(seconds=lease)).strftime(database.settings.DATETIME_FORMAT), now.strftime(database.settings.DATETIME_FORMAT), limit))
+        if not response.ok:
+            raise Exception("Could not claim mails")
+        return sorted(response.results, key=lambda mail: mail['mail_id'])
+
+    def update_mail(self, *, mail_id: int, **kwargs) -> None:
+        assignments, parameters = self.make_query_from_dict(', ', **kwargs)
+        response = self.execute(f"UPDATE mail SET {assignments} WHERE mail_id = ?", parameters + (mail_id,))
+        if not response.ok:
+            raise Exception("Could not update mail")
+
+    @staticmethod
+    def use_failed(data: dict) -> bool:
+        """Return whether a use (use_data) is an error, of the API (e.g. inactive token) or of its query (the API status is 200 then)"""
+        return (data.get('status') or 0) >= 400 or ((data.get('database_response') or {}).get('status') or 0) >= 400
+
+    @staticmethod
+    def rollup_starts(use_creation: str) -> dict:
+        """Return the start of the minute, hour and day containing use_creation (DATETIME_FORMAT)"""
+        return {
+            'minute': use_creation[:16] + ':00',
+            'hour': use_creation[:13] + ':00:00',
+            'day': use_creation[:10] + ' 00:00:00',
+        }
+
     def select_uses(self, **kwargs):
         """
         :return: list of uses match according to kwargs
         :rtype: list[database.root.types.use.Use]
         """
-        response = self.execute(f"SELECT * FROM use WHERE {self.make_query_from_dict(' and ', **kwargs)}")
+        where, parameters = self.make_query_from_dict(' and ', **kwargs)
+        response = self.execute(f"SELECT * FROM use WHERE {where}", parameters)
         results = []
         if response.ok:
             for use_dict in response.results:
                 results.append(database.root.types.use.Use.from_dict(use_dict))
         return results
 
+    def select_uses_page(self, *, token_id: int, limit: int, before_use_id: int or None = None):
+        """
+        Newest uses of a token first, continuing after before_use_id (keyset pagination, cost independent of the page)
+        :return: list of at most limit uses
+        :rtype: list[database.root.types.use.Use]
+        """
+        if before_use_id is None:
+            response = self.execute("SELECT * FROM use WHERE token_id = ? ORDER BY use_id DESC LIMIT ?", (token_id, limit))
+        else:
+            response = self.execute("SELECT * FROM use WHERE token_id = ? AND use_id < ? ORDER BY use_id DESC LIMIT ?", (token_id, before_use_id, limit))
+        if not response.ok:
+            raise Exception("Could not get uses")
+        return [database.root.types.use.Use.from_dict(use_dict) for use_dict in response.results]
+
+    def select_use_summary(self, *, token_id: int, period: str, since: str) -> dict:
+        """
+        Sum the use_rollup counters of a token from the period rollups starting at or after since
+        :return: {'requests': int, 'errors': int, 'bytes': int}
+        """
+        response = self.execute(
+            "SELECT total(rollup_requests) AS requests, total(rollup_errors) AS errors, total(rollup_bytes) AS bytes FROM use_rollup WHERE token_id = ? AND rollup_period = ? AND rollup_start >= ?",
+            (token_id, period, since)
+        )
+        if not response.ok:
+            raise Exception("Could not get use summary")
+        return {k: int(v) for k, v in response.results[0].items()}
+
 
 if __name__ == "__main__":
     pass
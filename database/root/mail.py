@@ -0,0 +1,257 @@
+import atexit
+import datetime
+import email.message
+import importlib
+import logging
+import mailbox
+import os
+import smtplib
+import threading
+import database.settings
+import database.metrics
+import database.root
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPTransport:
+    """Sends mails through an SMTP server, the connection is opened on the first mail and reused until close"""
+
+    def __init__(self, *, host: str, port: int, ssl: bool, user: str or None, password: str or None, timeout: float):
+        """
+        :param ssl: connect with SMTP_SSL, plain SMTP (upgraded with STARTTLS when offered) otherwise
+        :param user: login of the server, None to send without logging in
+        """
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.smtp = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            host=database.settings.MAIL_SMTP_HOST,
+            port=database.settings.MAIL_SMTP_PORT,
+            ssl=database.settings.MAIL_SMTP_SSL,
+            user=database.settings.MAIL_SMTP_USER,
+            password=database.settings.MAIL_SMTP_PASSWORD,
+            timeout=database.settings.MAIL_SMTP_TIMEOUT,
+        )
+
+    def open(self) -> None:
+        if self.smtp is not None:
+            return
+        if self.ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            smtp.ehlo()
+            if smtp.has_extn('starttls'):
+                smtp.starttls()
+                smtp.ehlo()
+        try:
+            if self.user:
+                smtp.login(self.user, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+
+    def send(self, message: email.message.EmailMessage) -> None:
+        reused = self.smtp is not None
+        self.open()
+        try:
+            self.smtp.send_message(message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            if not reused:
+                raise
+            # the server dropped the connection while it was idle, try once more on a new one
+            self.open()
+            self.smtp.send_message(message)
+
+    def close(self) -> None:
+        smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+
+class FileTransport:
+    """Appends mails to an mbox file instead of sending them, for development and tests (read it back with mailbox.mbox)"""
+
+    def __init__(self, *, path: str):
+        self.path = path
+
+    @classmethod
+    def from_settings(cls):
+        return cls(path=database.settings.MAIL_FILE_PATH)
+
+    def send(self, message: email.message.EmailMessage) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        box = mailbox.mbox(self.path)
+        box.lock()
+        try:
+            box.add(message)
+            box.flush()
+        finally:
+            box.unlock()
+            box.close()
+
+    def close(self) -> None:
+        pass
+
+
+# MAIL_TRANSPORT -> function returning the transport
+TRANSPORTS = {
+    'smtp': SMTPTransport.from_settings,
+    'file': FileTransport.from_settings,
+}
+
+
+def make_transport(name: str):
+    """
+    :param name: a key of TRANSPORTS, or the "module:Class" path of a class taking no arguments with send(message) and close()
+    """
+    if name in TRANSPORTS:
+        return TRANSPORTS[name]()
+    if ':' not in name:
+        raise Exception(f"Unknown mail transport: {name}")
+    module_name, class_name = name.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class MailDispatcher:
+    """
+    Sends the mails of the outbox (root.db mail table) from a background thread, so requests only have to insert them
+    Due mails are claimed in batches of batch_size and sent through one transport connection, which is closed once the outbox is empty
+    A mail that can't be sent is tried again after retry_delay seconds, doubled at every attempt, and given up after max_attempts
+    """
+
+    def __init__(self, *, transport, sender: str, batch_size: int, poll_interval: float, max_attempts: int, retry_delay: float, claim_lease: float):
+        """
+        :param transport: object with send(email.message.EmailMessage) and close()
+        :param sender: From address of the mails
+        :param poll_interval: seconds between two looks at the outbox when nobody calls wake
+        :param claim_lease: seconds a claimed mail is left alone by other dispatchers (and sent again if this one never reports back)
+        """
+        assert type(batch_size) is int and batch_size > 0
+        assert type(max_attempts) is int and max_attempts > 0
+
+        self.transport = transport
+        self.sender = sender
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_lease = claim_lease
+        self.lock = threading.Lock()
+        self.woken = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.counters = {'sent': 0, 'failed': 0, 'given_up': 0, 'batches': 0, 'errors': 0}
+
+    def wake(self) -> None:
+        """Look at the outbox now, called after a mail is queued"""
+        self.start()
+        self.woken.set()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name="mail-dispatcher", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout: float or None = None) -> None:
+        """Stop the background thread, mails not sent yet stay in the outbox"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopping.set()
+            self.woken.set()
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            self.woken.clear()
+            try:
+                while self.dispatch() == self.batch_size and not self.stopping.is_set():
+                    pass
+            except Exception:
+                logger.exception("Could not dispatch the mails of the outbox")
+                self._count('errors')
+            self.transport.close()
+            self.woken.wait(self.poll_interval)
+
+    def dispatch(self) -> int:
+        """
+        Send one batch of due mails
+        :return: amount of mails claimed
+        """
+        with database.root.RootDatabase() as root_db:
+            mails = root_db.claim_mails(limit=self.batch_size, lease=self.claim_lease)
+        if not mails:
+            return 0
+        updates = []
+        for mail in mails:
+            try:
+                self.transport.send(self.message(mail))
+            except Exception as e:
+                now = datetime.datetime.now()
+                if mail['mail_attempts'] >= self.max_attempts:
+                    logger.error("Gave up sending mail %d to %s after %d attempts: %s", mail['mail_id'], mail['mail_recipient'], mail['mail_attempts'], e)
+                    updates.append((mail['mail_id'], {'mail_status': 'failed', 'mail_error': str(e)}))
+                    self._count('given_up')
+                else:
+                    logger.warning("Could not send mail %d to %s (attempt %d): %s", mail['mail_id'], mail['mail_recipient'], mail['mail_attempts'], e)
+                    next_attempt = now + datetime.timedelta(seconds=self.retry_delay * 2 ** (mail['mail_attempts'] - 1))
+                    updates.append((mail['mail_id'], {'mail_next_attempt': next_attempt.strftime(database.settings.DATETIME_FORMAT), 'mail_error': str(e)}))
+                self._count('failed')
+                # a broken connection must not fail the rest of the batch
+                self.transport.close()
+            else:
+                sent = datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT)
+                updates.append((mail['mail_id'], {'mail_status': 'sent', 'mail_sent': sent, 'mail_error': None}))
+                self._count('sent')
+        with database.root.RootDatabase() as root_db:
+            for mail_id, fields in updates:
+                root_db.update_mail(mail_id=mail_id, **fields)
+        self._count('batches')
+        return len(mails)
+
+    def message(self, mail: dict) -> email.message.EmailMessage:
+        message = email.message.EmailMessage()
+        message['From'] = self.sender
+        message['To'] = mail['mail_recipient']
+        message['Subject'] = mail['mail_subject']
+        message.set_content(mail['mail_body'])
+        return message
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] += amount
+
+
+DISPATCHER = MailDispatcher(
+    transport=make_transport(database.settings.MAIL_TRANSPORT),
+    sender=database.settings.MAIL_SENDER,
+    batch_size=database.settings.MAIL_BATCH_SIZE,
+    poll_interval=database.settings.MAIL_POLL_INTERVAL,
+    max_attempts=database.settings.MAIL_MAX_ATTEMPTS,
+    retry_delay=database.settings.MAIL_RETRY_DELAY,
+    claim_lease=database.settings.MAIL_CLAIM_LEASE,
+)
+database.metrics.Collected("mail_dispatcher", "Mails sent, failed attempts, mails given up and outbox batches", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in DISPATCHER.stats().items()})
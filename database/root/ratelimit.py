@@ -0,0 +1,139 @@
+import atexit
+import collections
+import datetime
+import logging
+import threading
+import time
+import database.settings
+import database.limits
+import database.metrics
+import database.root
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token buckets (rate and burst) and daily quotas of the API tokens, as configured for their tier in TOKEN_TIERS
+    Decisions only use memory, root.db is never read nor written by check
+    The requests counted against the quotas are added to root.db (token_quota) every flush_interval seconds by a background thread,
+    which reads back the totals of the day as well, so requests made through other processes count too
+    """
+
+    def __init__(self, *, max_tokens: int, flush_interval: float):
+        """
+        :param max_tokens: maximum amount of tokens kept in memory, the least recently used is forgotten (and starts over with a full bucket)
+        :param flush_interval: seconds between two writes of the quota usage
+        """
+        assert type(max_tokens) is int and max_tokens > 0
+
+        self.max_tokens = max_tokens
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # token_token -> [tier, bucket level, time of the level, token_id, quota_day, requests of the day], least recently used first
+        self.entries = collections.OrderedDict()
+        self.pending = collections.Counter()  # (token_token, token_id, quota_day) -> requests not yet written
+        self.stopping = threading.Event()
+        self.thread = None
+        self.counters = {'allowed': 0, 'limited': 0, 'over_quota': 0, 'flushes': 0, 'failed': 0}
+
+    def check(self, token) -> (str or None, float or None):
+        """
+        Count a request made through token
+        :type token: database.root.types.token.Token
+        :return: (None, None) if it may go on, (error message, seconds to wait before retrying) if it may not
+        """
+        self.start()
+        tier = database.limits.tier_settings(token.token_tier)
+        rate, daily_quota = tier.get('rate'), tier.get('daily_quota')
+        # a bucket below one request never admits any, e.g. rate 0.5 without burst
+        capacity = None if rate is None else max(1, tier.get('burst') or rate)
+        now = time.monotonic()
+        today = datetime.date.today().isoformat()
+        with self.lock:
+            entry = self.entries.get(token.token_token)
+            if entry is None:
+                entry = [token.token_tier, capacity, now, token.token_id, today, 0]
+                self.entries[token.token_token] = entry
+                while len(self.entries) > self.max_tokens:
+                    self.entries.popitem(last=False)
+            elif entry[0] != token.token_tier:
+                entry[0], entry[1], entry[2] = token.token_tier, capacity, now  # new bucket, the quota usage is kept
+            self.entries.move_to_end(token.token_token)
+
+            if rate is not None:
+                entry[1] = min(capacity, entry[1] + (now - entry[2]) * rate)
+                entry[2] = now
+                if entry[1] < 1:
+                    self.counters['limited'] += 1
+                    return f"Rate limit exceeded: {rate} requests per second", (1 - entry[1]) / rate
+
+            if entry[4] != today:
+                entry[4], entry[5] = today, 0
+            if daily_quota is not None and entry[5] >= daily_quota:
+                self.counters['over_quota'] += 1
+                tomorrow = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+                return f"Daily quota exceeded: {daily_quota} requests", (tomorrow - datetime.datetime.now()).total_seconds()
+
+            if rate is not None:
+                entry[1] -= 1
+            entry[5] += 1
+            self.pending[(token.token_token, token.token_id, today)] += 1
+            self.counters['allowed'] += 1
+        return None, None
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name="quota-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout: float or None = None) -> None:
+        """Write the pending quota usage and stop the background thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopping.set()
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, tokens=len(self.entries), pending=sum(self.pending.values()))
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, collections.Counter()
+        if not pending:
+            return
+        try:
+            with database.root.RootDatabase() as root_db:
+                totals = root_db.add_token_quotas({(token_id, quota_day): requests for (_, token_id, quota_day), requests in pending.items()})
+        except Exception:
+            logger.exception("Could not write the quota usage of %d tokens", len(pending))
+            with self.lock:
+                self.pending.update(pending)  # tried again with the next flush
+                self.counters['failed'] += 1
+            return
+        with self.lock:
+            self.counters['flushes'] += 1
+            for token_token, token_id, quota_day in pending:
+                entry = self.entries.get(token_token)
+                if entry is not None and entry[4] == quota_day:
+                    # every request written so far, from any process, plus the ones counted here meanwhile
+                    entry[5] = totals[(token_id, quota_day)] + self.pending[(token_token, token_id, quota_day)]
+
+
+LIMITER = RateLimiter(
+    max_tokens=database.settings.RATE_LIMIT_MAX_TOKENS,
+    flush_interval=database.settings.QUOTA_FLUSH_INTERVAL,
+)
+database.metrics.Collected("rate_limiter", "Rate limiter decisions, quota writes and tracked tokens", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in LIMITER.stats().items()})
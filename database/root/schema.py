@@ -0,0 +1,245 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import database.settings
+
+logger = logging.getLogger(__name__)
+
+
+def statements(script: str):
+    """Split a SQL script into single statements, so it can run inside an explicit transaction"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+    if statement.strip():
+        yield statement.strip()
+
+
+def run_script(cursor: sqlite3.Cursor, path: str) -> None:
+    with open(path) as f:
+        for statement in statements(f.read()):
+            cursor.execute(statement)
+
+
+def root_tables(cursor: sqlite3.Cursor) -> None:
+    run_script(cursor, database.settings.ROOT_TABLES_SCRIPT_PATH)
+
+
+def compact_uses(cursor: sqlite3.Cursor) -> None:
+    """Rewrite use_data stored as the full API response into the compact record (results dropped)"""
+    last_use_id = 0
+    while True:
+        rows = cursor.execute("SELECT use_id, use_data FROM use WHERE use_id > ? ORDER BY use_id LIMIT 1000", (last_use_id,)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for use_id, use_data in rows:
+            try:
+                data = json.loads(use_data)
+            except ValueError:
+                continue
+            if 'bytes' in data:
+                continue
+            compact = {
+                'status': data.get('status'),
+                'query': data.get('query'),
+                'bytes': len(use_data),  # use_data was exactly the body sent back
+                'error_message': data.get('error_message'),
+                'database_response': None,
+            }
+            database_response = data.get('database_response')
+            if database_response:
+                results = database_response.get('results')
+                compact['database_response'] = {
+                    'status': database_response.get('status'),
+                    'query': database_response.get('query'),
+                    'query_hash': hashlib.sha1(str(database_response.get('query')).encode()).hexdigest(),
+                    'rows': None if results is None else len(results),
+                    'lastrowid': database_response.get('lastrowid'),
+                    'duration': None,
+                    'error_message': database_response.get('error_message'),
+                }
+            updates.append((json.dumps(compact), use_id))
+        cursor.executemany("UPDATE use SET use_data = ? WHERE use_id = ?", updates)
+        last_use_id = rows[-1][0]
+
+
+def indexes(cursor: sqlite3.Cursor) -> None:
+    """
+    Indexes for the hot lookups
+    token.token_token and user.user_email are already covered by the indexes behind their unique constraints
+    and token.user_id by the leftmost column of the (user_id, token_database_name) one
+    Tokens already sharing a database (made by concurrent creations before this index) are reported and kept,
+    token.user_id gets a plain index instead and the unique one must be created by hand once they are dealt with
+    """
+    duplicates = cursor.execute("""
+        SELECT user_id, token_database_name, group_concat(token_id, ', ')
+        FROM token
+        GROUP BY user_id, token_database_name
+        HAVING count(*) > 1
+    """).fetchall()
+    if duplicates:
+        for user_id, token_database_name, token_ids in duplicates:
+            logger.error("Tokens %s of user %d share the database %s", token_ids, user_id, token_database_name)
+        logger.error("Not creating the unique index of the tokens (new duplicates aren't refused until it exists), delete all but one token of each database then run: "
+                     "CREATE UNIQUE INDEX token_user_id_token_database_name ON token (user_id, token_database_name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS token_user_id ON token (user_id)")
+    else:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS token_user_id_token_database_name ON token (user_id, token_database_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS use_token_id ON use (token_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS use_use_creation ON use (use_creation)")
+
+
+def use_rollups(cursor: sqlite3.Cursor) -> None:
+    """Per token request counters by minute, hour and day, kept up to date by RootDatabase.insert_uses"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS use_rollup
+        (
+            token_id        integer not null,
+            rollup_period   text    not null check (rollup_period in ('minute', 'hour', 'day')),
+            rollup_start    text    not null,
+            rollup_requests integer not null default 0,
+            rollup_errors   integer not null default 0,
+            rollup_bytes    integer not null default 0,
+            primary key (token_id, rollup_period, rollup_start),
+            foreign key (token_id) references token (token_id)
+        )
+    """)
+    for period, start in ROLLUP_STARTS.items():
+        cursor.execute(f"""
+            INSERT INTO use_rollup (token_id, rollup_period, rollup_start, rollup_requests, rollup_errors, rollup_bytes)
+            SELECT token_id, '{period}', {start}, count(*), total(json_extract(use_data, '$.status') >= 400), total(json_extract(use_data, '$.bytes'))
+            FROM use
+            GROUP BY 1, 2, 3
+        """)
+
+
+def token_tiers(cursor: sqlite3.Cursor) -> None:
+    """Tier of each token, which picks the limits (TOKEN_TIERS) of its queries"""
+    cursor.execute("ALTER TABLE token ADD COLUMN token_tier text not null default 'default'")
+
+
+def token_quotas(cursor: sqlite3.Cursor) -> None:
+    """Requests made through each token per day, counted against the daily_quota of its tier"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS token_quota
+        (
+            token_id       integer not null,
+            quota_day      text    not null,
+            quota_requests integer not null default 0,
+            primary key (token_id, quota_day),
+            foreign key (token_id) references token (token_id)
+        )
+    """)
+
+
+def mail_outbox(cursor: sqlite3.Cursor) -> None:
+    """Mails waiting to be sent (or already sent) by the mail dispatcher"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mail
+        (
+            mail_id           integer not null primary key autoincrement,
+            mail_recipient    text    not null,
+            mail_subject      text    not null,
+            mail_body         text    not null,
+            mail_creation     text    not null,
+            mail_status       text    not null default 'pending' check (mail_status in ('pending', 'sent', 'failed')),
+            mail_attempts     integer not null default 0,
+            mail_next_attempt text    not null,
+            mail_sent         text,
+            mail_error        text
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS mail_pending ON mail (mail_next_attempt) WHERE mail_status = 'pending'")
+
+
+def use_rollup_errors(cursor: sqlite3.Cursor) -> None:
+    """
+    Count the uses whose query failed as errors too (API status 200, database_response status 400), the minute rollups are only kept for an hour
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS use_rollup_period_start ON use_rollup (rollup_period, rollup_start)")
+    for period, start in ROLLUP_STARTS.items():
+        cursor.execute(f"""
+            UPDATE use_rollup SET rollup_errors = uses.errors
+            FROM (SELECT token_id, {start} AS start, total({USE_FAILED}) AS errors FROM use GROUP BY 1, 2) AS uses
+            WHERE use_rollup.rollup_period = '{period}' AND use_rollup.token_id = uses.token_id AND use_rollup.rollup_start = uses.start
+        """)
+    cursor.execute("DELETE FROM use_rollup WHERE rollup_period = 'minute' AND rollup_start < datetime('now', 'localtime', '-1 hour')")
+
+
+# SQL expression of the start of the period containing use_creation (DATETIME_FORMAT)
+ROLLUP_STARTS = {
+    'minute': "substr(use_creation, 1, 16) || ':00'",
+    'hour': "substr(use_creation, 1, 13) || ':00:00'",
+    'day': "substr(use_creation, 1, 10) || ' 00:00:00'",
+}
+
+# SQL expression of whether a use is an error, as RootDatabase.use_failed
+USE_FAILED = "(coalesce(json_extract(use_data, '$.status'), 0) >= 400 OR coalesce(json_extract(use_data, '$.database_response.status'), 0) >= 400)"
+
+# Migration N brings the database from user_version N - 1 to user_version N, never edit an applied one, append a new one
+MIGRATIONS = [
+    root_tables,
+    compact_uses,
+    indexes,
+    use_rollups,
+    token_tiers,
+    token_quotas,
+    mail_outbox,
+    use_rollup_errors,
+]
+
+lock = threading.Lock()
+migrated = set()  # paths already at the latest version in this process
+
+
+def version(conn: sqlite3.Connection) -> int:
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Apply every pending migration to the database in a single write transaction
+    :return: the schema version of the database
+    """
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    if conn.in_transaction:
+        conn.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        current = version(conn)
+        for number, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return max(current, len(MIGRATIONS))
+
+
+def ensure(conn: sqlite3.Connection, path: str) -> None:
+    """Make sure the database at path is migrated, only the first call per path and process touches the schema"""
+    if path in migrated:
+        return
+    with lock:
+        if path not in migrated:
+            if version(conn) < len(MIGRATIONS):
+                migrate(conn)
+            migrated.add(path)
+
+
+if __name__ == "__main__":
+    # Run the migrations at deploy time: python -m database.root.schema
+    import database.root
+
+    with database.root.RootDatabase() as root_db:
+        print(f"{root_db.path} at schema version {version(root_db.conn)}")
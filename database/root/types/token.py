@@ -1,15 +1,23 @@
-import smtplib
 import datetime
 import jwt
 import secrets
 import database.settings
+import database.cache
+import database.limits
+import database.metrics
 import database.root
+import database.root.mail
 import database.root.types.use
 
+# token_token -> Token (with its user email resolved) for tokens that exist
+CACHE = database.cache.TTLCache(database.settings.TOKEN_CACHE_SIZE, database.settings.TOKEN_CACHE_TTL)
+# token_token -> None for tokens that don't, kept apart so a flood of invalid tokens can't evict valid ones
+NEGATIVE_CACHE = database.cache.TTLCache(database.settings.TOKEN_NEGATIVE_CACHE_SIZE, database.settings.TOKEN_NEGATIVE_CACHE_TTL)
+
 
 class Token:
     def __init__(self, token_id: int, user_id: int, token_token: str, token_database_name: str, token_creation: str or datetime.datetime, token_active: int, token_activation_code: str = None,
-                 token_activation_code_expiration: str or datetime.datetime = None):
+                 token_activation_code_expiration: str or datetime.datetime = None, token_tier: str = 'default'):
         """
         :param token_id: Integer that uniquely identifies tokens
         :param user_id: User integer to which this token belongs
@@ -19,6 +27,7 @@ class Token:
         :param token_active: 1 or 0 representing active and inactive, respectively
         :param token_activation_code: Activation code sent by email
         :param token_activation_code_expiration: Date when the activation code expires
+        :param token_tier: name of the limits (TOKEN_TIERS) of the queries run through this token
         """
         self.token_id = token_id
         self.user_id = user_id
@@ -28,6 +37,8 @@ class Token:
         self.token_active = token_active
         self.token_activation_code = token_activation_code
         self.token_activation_code_expiration = token_activation_code_expiration
+        self.token_tier = token_tier
+        self._user_email = None
 
     @classmethod
     def from_dict(cls, token_dict):
@@ -41,10 +52,49 @@ class Token:
             return results[0]
         raise Exception('Token not found')
 
+    @classmethod
+    def authenticate(cls, token_token: str):
+        """
+        Return the token (with user_email already resolved) or None if it doesn't exist
+        Answers from the in-process cache when possible, root.db is only read on a miss
+        :rtype: Token or None
+        """
+        with database.metrics.AUTH_SECONDS.time():
+            found, token = CACHE.lookup(token_token)
+            if found or NEGATIVE_CACHE.lookup(token_token)[0]:
+                return token
+            # a change committed while root.db is read must not be cached over
+            generation, negative_generation = CACHE.generation, NEGATIVE_CACHE.generation
+            with database.root.RootDatabase() as root_db:
+                results = root_db.select_tokens(token_token=token_token)
+                if results:
+                    token = results[0]
+                    token._user_email = root_db.select_user(user_id=token.user_id).user_email
+            if token:
+                CACHE.set(token_token, token, alias=token.token_id, generation=generation)
+            else:
+                NEGATIVE_CACHE.set(token_token, None, generation=negative_generation)
+            return token
+
+    @staticmethod
+    def invalidate(*, token_id: int or str or None = None, token_token: str or None = None) -> None:
+        """Forget cached authentication results, must be called whenever a token row changes, once the change is committed"""
+        if token_token is not None:
+            CACHE.invalidate(token_token)
+            NEGATIVE_CACHE.invalidate(token_token)
+        if token_id is not None:
+            CACHE.invalidate_alias(int(token_id))
+
     @property
     def user_email(self):
-        with database.root.RootDatabase() as root_db:
-            return root_db.select_user(user_id=self.user_id).user_email
+        if self._user_email is None:
+            with database.root.RootDatabase() as root_db:
+                self._user_email = root_db.select_user(user_id=self.user_id).user_email
+        return self._user_email
+
+    @property
+    def limits(self) -> database.limits.QueryLimits:
+        return database.limits.QueryLimits.for_tier(self.token_tier)
 
     def verify_code(self, activation_code: str) -> None:
         """Return whether the code was verified"""
@@ -63,22 +113,17 @@ class Token:
         raise Exception("Invalid activation code")
 
     def get_dict_update(self):
-        return {k: v for k, v in self.__dict__.items() if k not in ['token_id']}
+        return {k: v for k, v in self.__dict__.items() if k not in ['token_id'] and not k.startswith('_')}
 
     def create_activation_code(self, user):
+        """Save a new activation code and queue the mail sending it, the mail dispatcher delivers it in the background"""
         self.token_activation_code = secrets.token_hex(3).upper()
         self.token_activation_code_expiration = (datetime.datetime.now() + datetime.timedelta(minutes=30)).strftime(database.settings.DATETIME_FORMAT)
 
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login("regazzo.database.api@gmail.com", database.settings.GMAIL_APP_PASSWORD)
-            subject = "Confirmation Code from Database API"
-            body = f"Confirmation code: {self.token_activation_code}"
-            msg = f'Subject: {subject}\n\n{body}'
-            smtp.sendmail("regazzo.database.api@gmail.com", user.user_email, msg)
         with database.root.RootDatabase() as root_db:
             root_db.update_token(token_id=self.token_id, **self.get_dict_update())
-
-        # print(f"MOCK EMAIL SEND: to: {user.user_email} code: {self.token_activation_code} creation: {self.token_creation}")
+            root_db.insert_mail(mail_recipient=user.user_email, mail_subject="Confirmation Code from Database API", mail_body=f"Confirmation code: {self.token_activation_code}")
+        database.root.mail.DISPATCHER.wake()
 
     def __repr__(self):
         return f"<{type(self).__name__} {self.__dict__}>"
@@ -90,7 +135,7 @@ class Token:
         """
         with database.root.RootDatabase() as root_db:
             token = root_db.insert_token(user_id=user.user_id, token_token=secrets.token_hex(10), token_database_name=dbname)
-        token.create_activation_code(user)  # TODO: make this better
+        token.create_activation_code(user)
         return token
 
     def get_uses(self):
@@ -101,6 +146,35 @@ class Token:
         with database.root.RootDatabase() as root_db:
             return root_db.select_uses(token_id=self.token_id)
 
+    def get_uses_page(self, *, limit: int, before_use_id: int or None = None):
+        """
+        :return: list of at most limit uses from this token, newest first, older than before_use_id (if given)
+        :rtype: list[database.root.types.use.Use]
+        """
+        with database.root.RootDatabase() as root_db:
+            return root_db.select_uses_page(token_id=self.token_id, limit=limit, before_use_id=before_use_id)
+
+    def get_use_summary(self) -> dict:
+        """
+        Requests, errors, error rate and bytes sent over the last minute, hour, day and 30 days
+        Read from the use rollups, so the cost doesn't depend on the amount of uses
+        :return: {window name: {'requests': int, 'errors': int, 'error_rate': float, 'bytes': int}}
+        """
+        now = datetime.datetime.now()
+        windows = {
+            'Last minute': ('minute', now.replace(second=0)),
+            'Last hour': ('minute', now.replace(second=0) - datetime.timedelta(minutes=59)),
+            'Last day': ('hour', now.replace(minute=0, second=0) - datetime.timedelta(hours=23)),
+            'Last 30 days': ('day', now.replace(hour=0, minute=0, second=0) - datetime.timedelta(days=29)),
+        }
+        summary = {}
+        with database.root.RootDatabase() as root_db:
+            for name, (period, since) in windows.items():
+                counters = root_db.select_use_summary(token_id=self.token_id, period=period, since=since.strftime(database.settings.DATETIME_FORMAT))
+                counters['error_rate'] = counters['errors'] / counters['requests'] if counters['requests'] else 0.0
+                summary[name] = counters
+        return summary
+
 
 if __name__ == "__main__":
     pass
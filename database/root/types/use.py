@@ -1,5 +1,8 @@
 import jwt
+import hashlib
+import random
 import database.settings
+import database.root.usage
 import json
 
 
@@ -16,16 +19,48 @@ class Use:
         self.use_creation = use_creation
 
     @staticmethod
-    def create(api_response) -> bool:
+    def create(api_response, response_bytes: int, rows: int or None = None) -> bool:
         """
+        Queue the use for the background usage writer, root.db is written later in batches
         :param api_response: APIResponse object
+        :param response_bytes: size of the body sent back
+        :param rows: amount of rows sent back, when they were streamed instead of kept in the database response
+        :return: whether the use was queued
         """
-        try:
-            with database.root.RootDatabase() as root_db:
-                root_db.insert_use(token_token=api_response.token, use_data=api_response.json())
-        except:
-            return False
-        return True
+        return database.root.usage.WRITER.submit(api_response.token, Use.record(api_response, response_bytes, rows))
+
+    @staticmethod
+    def record(api_response, response_bytes: int, rows: int or None = None) -> dict:
+        """
+        Return the compact use_data of a request: everything but the results themselves
+        A USAGE_LOG_SAMPLE_RATE fraction of the records also keep the full response
+        :param api_response: APIResponse object
+        :param response_bytes: size of the body sent back
+        :param rows: amount of rows sent back, when they were streamed instead of kept in the database response
+        """
+        database_response = api_response.database_response
+        data = {
+            'status': api_response.status,
+            'query': api_response.query,
+            'bytes': response_bytes,
+            'error_message': api_response.error_message,
+            'database_response': None,
+        }
+        if database_response is not None:
+            if rows is None:
+                rows = database_response._rows
+            data['database_response'] = {
+                'status': database_response.status,
+                'query': database_response.query,
+                'query_hash': hashlib.sha1(database_response.query.encode()).hexdigest(),
+                'rows': rows,
+                'lastrowid': database_response.lastrowid,
+                'duration': database_response._duration,
+                'error_message': database_response.error_message,
+            }
+        if database.settings.USAGE_LOG_SAMPLE_RATE and random.random() < database.settings.USAGE_LOG_SAMPLE_RATE:
+            data['response'] = api_response.json_object()
+        return data
 
     @classmethod
     def from_dict(cls, use_dict):
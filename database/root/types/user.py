@@ -1,6 +1,13 @@
+import database.settings
+import database.cache
 import database.root
 import database.root.types.token
 
+# user_id -> User, users are never updated so entries only expire to pick up rows changed by hand
+CACHE = database.cache.TTLCache(database.settings.USER_CACHE_SIZE, database.settings.USER_CACHE_TTL)
+# fields carried by the signed session so most requests don't need root.db, checked again after USER_SESSION_TTL
+SESSION_FIELDS = ('user_id', 'user_fullname', 'user_email', 'user_active', 'user_creation')
+
 
 class User:
     def __init__(self, user_id: int, user_fullname: str, user_email: str, user_active: int, user_password: str, user_creation: str):
@@ -37,6 +44,27 @@ class User:
         else:
             raise Exception("Invalid inputs")
 
+    @classmethod
+    def get_cached(cls, *, user_id: int):
+        """Same as get(user_id=...) through the in-process cache"""
+        found, user = CACHE.lookup(user_id)
+        if not found:
+            user = cls.get(user_id=user_id)
+            CACHE.set(user_id, user)
+        return user
+
+    def session_payload(self) -> dict:
+        """Return the fields of the user but its password, to be kept in the (signed) session"""
+        return {k: getattr(self, k) for k in SESSION_FIELDS}
+
+    @classmethod
+    def from_session(cls, payload: dict):
+        """
+        Rebuild the user from session_payload without touching the database
+        Warning: the password is left out (check_pass always fails), use get to authenticate
+        """
+        return cls(user_password=None, **payload)
+
     @classmethod
     def create(cls, *, user_fullname, user_email, user_password):
         with database.root.RootDatabase() as root_db:
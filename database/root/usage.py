@@ -0,0 +1,130 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+import database.settings
+import database.metrics
+import database.root
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+
+class UsageWriter:
+    """
+    Writes usage records to root.db from a background thread
+    Records are queued by the request threads and inserted in batches, one transaction per batch,
+    flushed whenever batch_size records are waiting or flush_interval seconds went by
+    """
+
+    def __init__(self, *, max_queue: int, batch_size: int, flush_interval: float, policy: str, block_timeout: float):
+        """
+        :param max_queue: maximum amount of records waiting to be written
+        :param batch_size: maximum amount of records per insert transaction
+        :param flush_interval: maximum seconds a record waits for its batch to fill
+        :param policy: what to do with a record when the queue is full, 'drop' it or 'block' up to block_timeout before dropping it
+        :param block_timeout: seconds to wait for room in the queue under the 'block' policy
+        """
+        assert policy in ('drop', 'block')
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.lock = threading.Lock()
+        self.thread = None
+        self.counters = {'enqueued': 0, 'dropped': 0, 'written': 0, 'failed': 0, 'batches': 0}
+
+    def submit(self, token_token: str, payload) -> bool:
+        """
+        Queue a usage record, never touches the database
+        :param payload: use_data as a json object, serialized by the writer thread
+        :return: whether the record was queued (False if it was dropped)
+        """
+        self.start()
+        record = (token_token, payload, datetime.datetime.now().strftime(database.settings.DATETIME_FORMAT))
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        return True
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="usage-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout: float or None = None) -> None:
+        """Write every queued record and stop the writer thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(STOP)
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, queued=self.queue.qsize())
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is STOP:
+                break
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            self.write(batch)
+
+    def write(self, batch: list) -> None:
+        try:
+            rows = [(token_token, json.dumps(payload, default=lambda o: o.json_object()), use_creation) for token_token, payload, use_creation in batch]
+            with database.root.RootDatabase() as root_db:
+                if not root_db.insert_uses(rows):
+                    raise Exception("Could not add uses")
+        except Exception:
+            logger.exception("Could not write %d uses", len(batch))
+            self._count('failed', len(batch))
+        else:
+            self._count('written', len(batch))
+            self._count('batches')
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] += amount
+
+
+WRITER = UsageWriter(
+    max_queue=database.settings.USAGE_LOG_QUEUE_SIZE,
+    batch_size=database.settings.USAGE_LOG_BATCH_SIZE,
+    flush_interval=database.settings.USAGE_LOG_FLUSH_INTERVAL,
+    policy=database.settings.USAGE_LOG_POLICY,
+    block_timeout=database.settings.USAGE_LOG_BLOCK_TIMEOUT,
+)
+database.metrics.Collected("usage_writer", "Usage writer counters and queued records", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in WRITER.stats().items()})
@@ -2,7 +2,8 @@ import json
 import os
 
 current_dir = os.path.dirname(__file__)
-config_file_path = os.path.join(current_dir, '../config.json')
+# DATABASE_API_CONFIG points to another config file (e.g. the temporary one of the benchmarks)
+config_file_path = os.environ.get('DATABASE_API_CONFIG', os.path.join(current_dir, '../config.json'))
 
 with open(config_file_path) as file:
     CONFIG = json.load(file)
@@ -14,3 +15,152 @@ DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 ROOT_DATABASE_PATH = os.path.join(current_dir, CONFIG['ROOT_RELATIVE_PATH'])
 USER_DATABASE_PATH = os.path.join(current_dir, CONFIG['USER_RELATIVE_PATH'])
 ROOT_TABLES_SCRIPT_PATH = os.path.join(current_dir, 'root_tables.sql')
+
+POOL_MAX_CONNECTIONS_PER_DATABASE = CONFIG.get('POOL_MAX_CONNECTIONS_PER_DATABASE', 4)
+POOL_MAX_CONNECTIONS = CONFIG.get('POOL_MAX_CONNECTIONS', 256)
+POOL_IDLE_TIMEOUT = CONFIG.get('POOL_IDLE_TIMEOUT', 300)
+POOL_HEALTH_CHECK_INTERVAL = CONFIG.get('POOL_HEALTH_CHECK_INTERVAL', 30)
+POOL_ACQUIRE_TIMEOUT = CONFIG.get('POOL_ACQUIRE_TIMEOUT', 10)
+# seconds a client is asked to wait (Retry-After) when no connection became available in time
+POOL_RETRY_AFTER = CONFIG.get('POOL_RETRY_AFTER', 1)
+# compiled statements kept per connection, the root queries are few and parameterized so they all fit
+SQLITE_CACHED_STATEMENTS = CONFIG.get('SQLITE_CACHED_STATEMENTS', 256)
+
+LOCK_TIMEOUT = CONFIG.get('LOCK_TIMEOUT')
+
+# PRAGMA profiles applied once to every new pooled connection
+# root.db takes a write for every API call (usage log), tenant databases are mostly read
+ROOT_PRAGMAS = CONFIG.get('ROOT_PRAGMAS', {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 5000,
+    'cache_size': -8000,
+    'temp_store': 'MEMORY',
+})
+USER_PRAGMAS = CONFIG.get('USER_PRAGMAS', {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+})
+
+TOKEN_CACHE_SIZE = CONFIG.get('TOKEN_CACHE_SIZE', 10000)
+TOKEN_CACHE_TTL = CONFIG.get('TOKEN_CACHE_TTL', 60)
+TOKEN_NEGATIVE_CACHE_SIZE = CONFIG.get('TOKEN_NEGATIVE_CACHE_SIZE', 10000)
+TOKEN_NEGATIVE_CACHE_TTL = CONFIG.get('TOKEN_NEGATIVE_CACHE_TTL', 10)
+
+USAGE_LOG_QUEUE_SIZE = CONFIG.get('USAGE_LOG_QUEUE_SIZE', 10000)
+USAGE_LOG_BATCH_SIZE = CONFIG.get('USAGE_LOG_BATCH_SIZE', 500)
+USAGE_LOG_FLUSH_INTERVAL = CONFIG.get('USAGE_LOG_FLUSH_INTERVAL', 1.0)
+USAGE_LOG_POLICY = CONFIG.get('USAGE_LOG_POLICY', 'drop')
+USAGE_LOG_BLOCK_TIMEOUT = CONFIG.get('USAGE_LOG_BLOCK_TIMEOUT', 0.5)
+# fraction of the usage records that also keep the full response (results included)
+USAGE_LOG_SAMPLE_RATE = CONFIG.get('USAGE_LOG_SAMPLE_RATE', 0)
+
+# rows fetched and written at a time by streamed query responses (stream=1)
+STREAM_CHUNK_SIZE = CONFIG.get('STREAM_CHUNK_SIZE', 500)
+
+LOG_LEVEL = CONFIG.get('LOG_LEVEL', 'INFO')
+LOG_JSON = CONFIG.get('LOG_JSON', False)
+LOG_QUEUE_SIZE = CONFIG.get('LOG_QUEUE_SIZE', 10000)
+# maximum length of the results shown when a database response is logged
+LOG_PREVIEW_LENGTH = CONFIG.get('LOG_PREVIEW_LENGTH', 200)
+
+# uses shown per page on /database/stats
+STATS_PAGE_SIZE = CONFIG.get('STATS_PAGE_SIZE', 50)
+
+USER_CACHE_SIZE = CONFIG.get('USER_CACHE_SIZE', 10000)
+USER_CACHE_TTL = CONFIG.get('USER_CACHE_TTL', 300)
+# seconds the user fields carried by the session are trusted before being checked against root.db again
+USER_SESSION_TTL = CONFIG.get('USER_SESSION_TTL', 300)
+
+# statements accepted by one /api/v1/batch/ request
+BATCH_MAX_STATEMENTS = CONFIG.get('BATCH_MAX_STATEMENTS', 1000)
+
+# cache of read-only query responses, used by requests with cache=1
+RESULT_CACHE_ENABLED = CONFIG.get('RESULT_CACHE_ENABLED', True)
+RESULT_CACHE_MAX_BYTES = CONFIG.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+RESULT_CACHE_MAX_ENTRY_BYTES = CONFIG.get('RESULT_CACHE_MAX_ENTRY_BYTES', 1024 * 1024)
+RESULT_CACHE_TTL = CONFIG.get('RESULT_CACHE_TTL', 300)
+
+# async_server.py (ASGI): worker threads per database, thread pools kept, seconds a query may run before it is interrupted
+ASYNC_THREADS_PER_DATABASE = CONFIG.get('ASYNC_THREADS_PER_DATABASE', 2)
+ASYNC_MAX_DATABASE_EXECUTORS = CONFIG.get('ASYNC_MAX_DATABASE_EXECUTORS', 256)
+ASYNC_QUERY_TIMEOUT = CONFIG.get('ASYNC_QUERY_TIMEOUT', 30)
+
+# limits of the queries run through a token, picked by its token_tier (tokens of an unknown tier get the default one)
+# timeout: seconds, max_rows: rows returned (the rest is left out), max_bytes: size of the results, None for no limit
+# sqlite_limits: {name: value} of SQLITE_LIMIT_* (without the prefix) lowered while the query runs, needs python 3.11+
+# rate: requests per second, burst: requests made at once above that rate (rate by default, at least 1), daily_quota: requests per day
+# max_cursors: cursors of paged queries open at once (the least recently used is closed to open another), each holds a pooled connection so keep it below POOL_MAX_CONNECTIONS_PER_DATABASE
+TOKEN_TIERS = CONFIG.get('TOKEN_TIERS', {
+    'default': {
+        'rate': 20,
+        'burst': 100,
+        'daily_quota': 100000,
+        'timeout': 30,
+        'max_rows': 100000,
+        'max_bytes': 32 * 1024 * 1024,
+        'sqlite_limits': {'LENGTH': 16 * 1024 * 1024, 'SQL_LENGTH': 100000, 'ATTACHED': 0},
+        'max_cursors': 2,
+    },
+    'unlimited': {},
+})
+# virtual machine instructions between two checks of the query deadline
+QUERY_PROGRESS_STEPS = CONFIG.get('QUERY_PROGRESS_STEPS', 1000)
+
+# tokens whose request rate and daily quota are tracked in memory (TOKEN_TIERS rate, burst and daily_quota)
+RATE_LIMIT_MAX_TOKENS = CONFIG.get('RATE_LIMIT_MAX_TOKENS', 100000)
+# seconds between two writes of the daily quota usage to root.db
+QUOTA_FLUSH_INTERVAL = CONFIG.get('QUOTA_FLUSH_INTERVAL', 5)
+
+# timers and counters of the hot paths, served in the Prometheus text format at /metrics
+METRICS_ENABLED = CONFIG.get('METRICS_ENABLED', True)
+# addresses allowed to read /metrics (metric labels carry database names)
+METRICS_ALLOWED_ADDRESSES = CONFIG.get('METRICS_ALLOWED_ADDRESSES', ['127.0.0.1', '::1'])
+# databases with series of their own in the metrics (and lock wait stats), the least recently used others are counted as 'other'
+METRICS_MAX_DATABASES = CONFIG.get('METRICS_MAX_DATABASES', 100)
+
+# worker processes running the /api/v1/query/ queries (0 runs them in the request thread)
+# each database always goes to the same worker, chosen by consistent hashing of its path
+EXECUTOR_PROCESSES = CONFIG.get('EXECUTOR_PROCESSES', 0)
+EXECUTOR_VIRTUAL_NODES = CONFIG.get('EXECUTOR_VIRTUAL_NODES', 64)
+# results of at least this many bytes come back from a worker through shared memory instead of its pipe
+EXECUTOR_SHM_THRESHOLD = CONFIG.get('EXECUTOR_SHM_THRESHOLD', 256 * 1024)
+
+# activation mails go through the outbox (root.db mail table) and are sent by a background dispatcher
+# MAIL_TRANSPORT: 'smtp', 'file' (appends to the mbox at MAIL_FILE_PATH instead of sending) or "module:Class"
+MAIL_TRANSPORT = CONFIG.get('MAIL_TRANSPORT', 'smtp')
+MAIL_SENDER = CONFIG.get('MAIL_SENDER', 'regazzo.database.api@gmail.com')
+MAIL_SMTP_HOST = CONFIG.get('MAIL_SMTP_HOST', 'smtp.gmail.com')
+MAIL_SMTP_PORT = CONFIG.get('MAIL_SMTP_PORT', 465)
+MAIL_SMTP_SSL = CONFIG.get('MAIL_SMTP_SSL', True)
+MAIL_SMTP_USER = CONFIG.get('MAIL_SMTP_USER', MAIL_SENDER)
+MAIL_SMTP_PASSWORD = CONFIG.get('MAIL_SMTP_PASSWORD', GMAIL_APP_PASSWORD)
+MAIL_SMTP_TIMEOUT = CONFIG.get('MAIL_SMTP_TIMEOUT', 30)
+MAIL_FILE_PATH = os.path.join(current_dir, CONFIG['MAIL_FILE_PATH']) if 'MAIL_FILE_PATH' in CONFIG else os.path.join(ROOT_DATABASE_PATH, 'outbox.mbox')
+# mails sent per outbox batch (over one connection), seconds between two looks at the outbox
+MAIL_BATCH_SIZE = CONFIG.get('MAIL_BATCH_SIZE', 50)
+MAIL_POLL_INTERVAL = CONFIG.get('MAIL_POLL_INTERVAL', 30)
+# attempts before a mail is given up, seconds before the first retry (doubled at every attempt)
+MAIL_MAX_ATTEMPTS = CONFIG.get('MAIL_MAX_ATTEMPTS', 5)
+MAIL_RETRY_DELAY = CONFIG.get('MAIL_RETRY_DELAY', 60)
+# seconds a mail being sent is left alone by the dispatchers of other processes
+MAIL_CLAIM_LEASE = CONFIG.get('MAIL_CLAIM_LEASE', 300)
+
+# gzip or deflate compression of the /api/v1/query/ responses, for clients sending Accept-Encoding
+COMPRESSION_ENABLED = CONFIG.get('COMPRESSION_ENABLED', True)
+# zlib level (1 fastest to 9 smallest, low levels keep most of the gain for a fraction of the cpu), smaller bodies are sent as they are (streamed ones are always compressed)
+COMPRESSION_LEVEL = CONFIG.get('COMPRESSION_LEVEL', 3)
+COMPRESSION_MIN_BYTES = CONFIG.get('COMPRESSION_MIN_BYTES', 1024)
+
+# server-side cursors of paged queries (page_size), kept in the process that opened them
+# an open cursor holds a pooled connection and its read snapshot (the WAL can't be checkpointed past it)
+CURSOR_MAX_OPEN = CONFIG.get('CURSOR_MAX_OPEN', 128)
+# seconds a cursor is kept without a request for its next page, and at most
+CURSOR_TTL = CONFIG.get('CURSOR_TTL', 60)
+CURSOR_MAX_AGE = CONFIG.get('CURSOR_MAX_AGE', 600)
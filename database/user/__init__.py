@@ -1,36 +1,55 @@
 import sqlite3
-import threading
+import json
 import os
+import time
 import database.settings
+import database.limits
+import database.metrics
+import database.pool
+import database.locks
 import database.user.response
+import database.user.cache
 
+RESULT_FORMATS = ('objects', 'rows', 'columns')
+BATCH_MODES = ('transaction', 'savepoint')
 
-class UserDatabase:
-    lock = threading.RLock()
 
-    def __init__(self, folder_name: str, database_name: str, autocommit: bool = True, autorollback: bool = True):
+class UserDatabase:
+    def __init__(self, folder_name: str, database_name: str, autocommit: bool = True, autorollback: bool = True, limits: database.limits.QueryLimits or None = None):
         """
         :param folder_name: name of the folder that the database will be in (inside USER_DATABASE_PATH)
         :param database_name: name of the database
         :param autocommit: Whether the the database will commit if all goes right
         :param autorollback: Whether the database will rollback if something goes wrong
+        :param limits: resource guards of the queries (usually the ones of the token), None for no limit
         """
         assert type(folder_name) is str
         assert type(database_name) is str
         assert type(autocommit) is bool
         assert type(autorollback) is bool
+        assert isinstance(limits, database.limits.QueryLimits) or limits is None
 
+        self.path = self.path_of(folder_name, database_name)
+        self.autocommit = autocommit
+        self.autorollback = autorollback
+        self.limits = limits
+        self.guard = None  # guard of a streamed query still being read
+        self.written = False  # whether a write ran, the result cache is invalidated again once it is committed
+        self.conn = database.pool.POOL.acquire(self.path, database.settings.USER_PRAGMAS)
+        try:
+            self.conn.row_factory = None  # plain tuples, laid out by shape according to the requested format
+            self.cursor = self.conn.cursor()
+        except Exception:
+            database.pool.POOL.release(self.conn, discard=True)
+            raise
+
+    @staticmethod
+    def path_of(folder_name: str, database_name: str) -> str:
+        """Return the path of the database file"""
         path = os.path.join(database.settings.USER_DATABASE_PATH, folder_name, database_name)
         if os.path.splitext(path)[1] != ".db":
             path += ".db"
-        os.makedirs(os.path.split(path)[0], exist_ok=True)
-        self.path = path
-        self.autocommit = autocommit
-        self.autorollback = autorollback
-        self.conn = sqlite3.connect(path, check_same_thread=False)
-        self.conn.row_factory = lambda c, r: dict([(col[0], r[idx]) for idx, col in enumerate(c.description)])
-        self.cursor = self.conn.cursor()
-        self.cursor.execute("PRAGMA foreign_keys = ON;")
+        return path
 
     def __enter__(self):
         return self
@@ -38,45 +57,324 @@ class UserDatabase:
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         Closing context manager, verify if rollsback or commit and if they are enabled
+        The connection goes back to the pool instead of being closed
         Always raises (return False)
         """
-        if exc_type:
-            # something went wrong
-            if self.autorollback:
-                self.conn.rollback()
-        else:
-            # all good
-            if self.autocommit:
-                self.conn.commit()
-        self.conn.close()
+        try:
+            self._stop_guard()
+            if exc_type:
+                # something went wrong
+                if self.autorollback:
+                    self.conn.rollback()
+            else:
+                # all good
+                if self.autocommit:
+                    self.conn.commit()
+        except sqlite3.Error:
+            database.pool.POOL.release(self.conn, discard=True)
+            raise
+        finally:
+            if self.written:
+                database.user.cache.CACHE.bump(self.path)
+        database.pool.POOL.release(self.conn)
         return False  # raise exception
 
-    def execute(self, query: str):
+    def shared(self, query: str) -> bool:
+        """Return whether query may run alongside other readers of this database (only in WAL mode)"""
+        return self.conn.journal_mode == "wal" and database.locks.is_read(query)
+
+    @staticmethod
+    def shape(columns: list, rows: list, result_format: str) -> list:
+        """
+        Lay out rows (tuples) according to result_format
+        objects: one {column: value} per row
+        rows: one [value, ...] per row, in the order of columns
+        columns: one [value, ...] per column, in the order of columns
+        """
+        if result_format == 'objects':
+            return [dict(zip(columns, row)) for row in rows]
+        if result_format == 'columns':
+            return [list(column) for column in zip(*rows)] if rows else [[] for _ in columns]
+        return rows
+
+    def columns(self) -> list or None:
+        """Return the result column names of the last query (None if it returns no rows)"""
+        if self.cursor.description is None:
+            return None
+        return [column[0] for column in self.cursor.description]
+
+    def write(self, query: str or None = None) -> None:
+        """Invalidate the cached results of this database if query (None for any) may write"""
+        if query is None or not database.locks.is_read(query):
+            self.written = True
+            database.user.cache.CACHE.bump(self.path)
+
+    def _fetch(self) -> (list, bool):
+        """
+        Fetch the rows of the last query, at most max_rows of the limits
+        :return: (rows, whether rows were left out)
+        """
+        if self.limits is None or self.limits.max_rows is None:
+            return self.cursor.fetchall(), False
+        rows = self.cursor.fetchmany(self.limits.max_rows + 1)
+        if len(rows) <= self.limits.max_rows:
+            return rows, False
+        self._reset_cursor()
+        return rows[:self.limits.max_rows], True
+
+    def _failed(self, query: str, error: Exception, guard: database.limits.QueryGuard):
+        """
+        Response of a query that raised error
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        if guard.expired:
+            return database.user.response.UserDatabaseResponse.limited(query, 'timeout', self.limits.timeout, f"Query interrupted, it took longer than the {self.limits.timeout} seconds allowed")
+        return database.user.response.UserDatabaseResponse.bad(query, error_message=str(error))
+
+    def _too_big(self, query: str):
+        """
+        Response of a query whose results are bigger than max_bytes of the limits
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        return database.user.response.UserDatabaseResponse.limited(query, 'max_bytes', self.limits.max_bytes, f"Results are bigger than the {self.limits.max_bytes} bytes allowed")
+
+    def execute(self, query: str, result_format: str = 'objects', cache: bool = False):
         """
         Generic execute statement for ONE query
+        :param result_format: layout of the results, one of RESULT_FORMATS
+        :param cache: answer a read-only query from the result cache (if RESULT_CACHE_ENABLED) and cache its response
         :rtype: database.user.response.UserDatabaseResponse
         """
+        assert result_format in RESULT_FORMATS
+
+        if cache and database.settings.RESULT_CACHE_ENABLED and database.locks.is_read(query):
+            response = database.user.cache.CACHE.get(self.path, query, result_format)
+            if response is not None and self.limits is not None and not self.limits.allows(response):
+                response = None  # cached for a token with higher limits
+            if response is None:
+                version = database.user.cache.CACHE.version(self.path)
+                response = self.execute(query, result_format)
+                if response.ok and not response.truncated:
+                    database.user.cache.CACHE.put(self.path, query, result_format, version, response)
+            return response
+
+        self.write(query)
+        start = time.perf_counter()
+        guard = database.limits.QueryGuard(self.limits, self.conn)
+        try:
+            with guard, guard.lock(self.path, shared=self.shared(query)):
+                with database.metrics.QUERY_EXECUTE_SECONDS.time():
+                    self.cursor.execute(query)
+                with database.metrics.QUERY_FETCH_SECONDS.time():
+                    rows, truncated = self._fetch()
+        except Exception as e:
+            response = self._failed(query, e, guard)
+        else:
+            columns = self.columns()
+            response = database.user.response.UserDatabaseResponse.good(query, results=self.shape(columns or [], rows, result_format), lastrowid=self.cursor.lastrowid, columns=columns)
+            response._rows = len(rows)
+            response.truncated = truncated
+            if self.limits is not None and self.limits.max_bytes is not None:
+                # serialized once here, APIResponse.json sends this same json
+                response._results_json = json.dumps(response.results)
+                if len(response._results_json) > self.limits.max_bytes:
+                    response = self._too_big(query)
+        response._duration = time.perf_counter() - start
+        database.metrics.QUERIES.inc(database.metrics.database_label(self.path), response.status)
+        return response
+
+    def execute_stream(self, query: str, chunk_size: int, result_format: str = 'objects'):
+        """
+        Execute ONE query without fetching all its rows at once
+        The response carries no results, they come from the generator in lists of at most chunk_size rows
+        The generator must be consumed (or closed) before the context of this database exits
+        :param result_format: layout of the rows, 'objects' or 'rows' (a column layout can't be streamed)
+        :return: (response, generator of row chunks)
+        :rtype: (database.user.response.UserDatabaseResponse, generator)
+        """
+        assert result_format in ('objects', 'rows')
 
-        with self.lock:
-            try:
+        self.write(query)
+        shared = self.shared(query)
+        start = time.perf_counter()
+        self._stop_guard()
+        self.guard = database.limits.QueryGuard(self.limits, self.conn)
+        self.guard.start()
+        try:
+            with self.guard.lock(self.path, shared=shared):
                 self.cursor.execute(query)
-            except Exception as e:
-                return database.user.response.UserDatabaseResponse.bad(query, error_message=str(e))
+                rows = self.cursor.fetchmany(chunk_size)
+        except Exception as e:
+            response = self._failed(query, e, self.guard)
+            columns = None
+            rows = []
+        else:
+            columns = self.columns()
+            response = database.user.response.UserDatabaseResponse.good(query, lastrowid=self.cursor.lastrowid, columns=columns)
+        response._duration = time.perf_counter() - start
+        database.metrics.QUERIES.inc(database.metrics.database_label(self.path), response.status)
+        return response, self._chunks(response, rows, columns or [], shared, chunk_size, result_format)
+
+    def _chunks(self, response, rows: list, columns: list, shared: bool, chunk_size: int, result_format: str):
+        """
+        The limits apply to the stream as a whole (max_rows, max_bytes) or to each fetch (timeout), so slow readers aren't cut off
+        Hitting one is reported in response: truncated is set, or limit is set and the error is raised
+        """
+        max_rows = None if self.limits is None else self.limits.max_rows
+        max_bytes = None if self.limits is None else self.limits.max_bytes
+        sent = 0
+        size = 0  # bytes of the json of the chunks sent
+        try:
+            while rows:
+                if max_rows is not None and sent + len(rows) > max_rows:
+                    rows = rows[:max_rows - sent]
+                    response.truncated = True
+                sent += len(rows)
+                if rows:
+                    chunk = self.shape(columns, rows, result_format)
+                    if max_bytes is not None:
+                        # the chunk going over the limit is not sent
+                        size += len(json.dumps(chunk))
+                        if size > max_bytes:
+                            response.limit = {'name': 'max_bytes', 'value': max_bytes}
+                            raise Exception(self._too_big(response.query).error_message)
+                    yield chunk
+                if response.truncated or len(rows) < chunk_size:
+                    return
+                self.guard.restart()
+                try:
+                    with self.guard.lock(self.path, shared=shared):
+                        rows = self.cursor.fetchmany(chunk_size)
+                except Exception as e:
+                    if self.guard.expired:
+                        response.limit = {'name': 'timeout', 'value': self.limits.timeout}
+                        raise Exception(self._failed(response.query, e, self.guard).error_message)
+                    raise
+        finally:
+            if response.truncated or response.limit is not None:
+                self._reset_cursor()
+            self._stop_guard()
+
+    def _stop_guard(self) -> None:
+        if self.guard is not None:
+            self.guard.stop()
+            self.guard = None
+
+    def _reset_cursor(self) -> None:
+        """Drop the rows left in the cursor, so the statement doesn't keep its read transaction open"""
+        self.cursor.close()
+        self.cursor = self.conn.cursor()
+
+    def execute_batch(self, statements: list, mode: str = 'transaction', result_format: str = 'objects'):
+        """
+        Execute many statements on this connection in a single transaction
+        :param statements: list of {'q': query, 'params': list or dict (optional)}
+                           or {'q': query, 'many': list of params} to run the query once per params (executemany)
+        :param mode: transaction: the first failing statement rolls the whole batch back and stops it
+                     savepoint: a failing statement only rolls itself back, the batch goes on and the rest is committed
+        :param result_format: layout of the results of each statement, one of RESULT_FORMATS
+        :return: response whose results are the responses of the statements that ran, in order
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        assert mode in BATCH_MODES
+        assert result_format in RESULT_FORMATS
+
+        query = f"BATCH {mode} ({len(statements)} statements)"
+        self.write()
+        start = time.perf_counter()
+        responses = []
+        size = 0  # bytes of the json of the results so far, max_bytes is for the whole batch
+        guard = database.limits.QueryGuard(self.limits, self.conn)  # the timeout is for the whole batch
+        try:
+            with guard, guard.lock(self.path):
+                if self.conn.in_transaction:
+                    self.conn.commit()
+                self.cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    for statement in statements:
+                        if mode == 'savepoint':
+                            self.cursor.execute("SAVEPOINT batch_statement")
+                        response = self._execute_statement(statement, result_format, guard)
+                        if response.ok and self.limits is not None and self.limits.max_bytes is not None:
+                            size += len(json.dumps(response.results))
+                            if size > self.limits.max_bytes:
+                                response = self._too_big(statement['q'])
+                        responses.append(response)
+                        if guard.expired:
+                            guard.stop()  # the statements ending the transaction must not be interrupted too
+                        if mode == 'savepoint':
+                            if not response.ok:
+                                self.cursor.execute("ROLLBACK TO batch_statement")
+                            self.cursor.execute("RELEASE batch_statement")
+                        elif not response.ok:
+                            break
+                        if guard.expired or response.limit is not None:
+                            break
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                if mode == 'transaction' and not responses[-1].ok:
+                    self.conn.rollback()
+                else:
+                    self.conn.commit()
+        except Exception as e:
+            failure = self._failed(query, e, guard)  # the timeout is hit here while waiting for the lock
+            response = database.user.response.UserDatabaseResponse.bad(query, responses, error_message=failure.error_message)
+            response.limit = failure.limit
+        else:
+            failed = [number for number, response in enumerate(responses) if not response.ok]
+            if failed:
+                error_message = f"Statement {failed[0]} failed" + (", the batch was rolled back" if mode == 'transaction' else f" ({len(failed)} failed in total)")
+                response = database.user.response.UserDatabaseResponse.bad(query, responses, error_message=error_message)
+                response.limit = responses[-1].limit  # a limit always stops the batch
+            else:
+                response = database.user.response.UserDatabaseResponse.good(query, results=responses)
+        response._rows = sum([statement_response._rows or 0 for statement_response in responses])
+        response._duration = time.perf_counter() - start
+        database.metrics.QUERIES.inc(database.metrics.database_label(self.path), response.status, amount=len(responses))
+        return response
+
+    def _execute_statement(self, statement: dict, result_format: str, guard: database.limits.QueryGuard):
+        """Execute one statement of a batch (the caller holds the lock, the transaction and the guard)"""
+        query = statement['q']
+        self.conn.set_authorizer(self._deny_transaction_control)
+        try:
+            if 'many' in statement:
+                self.cursor.executemany(query, statement['many'])
+                rows, truncated = [], False
             else:
-                return database.user.response.UserDatabaseResponse.good(query, results=self.cursor.fetchall(), lastrowid=self.cursor.lastrowid)
+                self.cursor.execute(query, statement.get('params', ()))
+                rows, truncated = self._fetch()
+        except Exception as e:
+            return self._failed(query, e, guard)
+        finally:
+            self.conn.set_authorizer(None)
+        columns = self.columns()
+        response = database.user.response.UserDatabaseResponse.good(query, results=self.shape(columns or [], rows, result_format), lastrowid=self.cursor.lastrowid, columns=columns)
+        response._rows = len(rows)
+        response.truncated = truncated
+        return response
+
+    @staticmethod
+    def _deny_transaction_control(action: int, *args) -> int:
+        """Authorizer of the batch statements: they run inside the transaction (and savepoint) of the batch, which they may not end"""
+        if action in (sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT):
+            return sqlite3.SQLITE_DENY
+        return sqlite3.SQLITE_OK
 
     def executescript(self, script: str):
         """
         Generic execute statement for MULTIPLE queries
         It does NOT provide any information other than error_message (useless in 'select' query)
         """
-        with self.lock:
-            try:
+        self.write()
+        try:
+            with database.locks.LOCKS.hold(self.path):
                 self.cursor.executescript(script)
-            except Exception as e:
-                return database.user.response.UserDatabaseResponse.bad(script, error_message=str(e))
-            else:
-                return database.user.response.UserDatabaseResponse.good(script)
+        except Exception as e:
+            return database.user.response.UserDatabaseResponse.bad(script, error_message=str(e))
+        else:
+            return database.user.response.UserDatabaseResponse.good(script)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+import collections
+import copy
+import json
+import os
+import re
+import threading
+import time
+import database.settings
+import database.metrics
+
+TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\s+|[^'\"\s]+|['\"]")
+
+
+def file_stamp(path: str) -> tuple:
+    """Modification time and size of the database file and of its -wal file, they change with every write, from any process"""
+    stamp = ()
+    for file_path in (path, path + '-wal'):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            stamp += (None, None)
+        else:
+            stamp += (stat.st_mtime_ns, stat.st_size)
+    return stamp
+
+
+def normalize(query: str) -> str:
+    """Collapse the whitespace of query outside of quoted literals, so formatting differences share a cache entry"""
+    return "".join([" " if token.isspace() else token for token in TOKENS.findall(query)]).strip()
+
+
+class ResultCache:
+    """
+    Responses of read-only queries, evicted least recently used first once their serialized results exceed max_bytes
+    Every database path has a write counter, bumped by each write and commit, and entries of an older counter are stale
+    Writes made by other processes are seen through the modification time and size of the database and -wal files (file_stamp)
+    stored with every entry, which are only as fine as the file system clock, so entries also expire after ttl seconds
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int, ttl: float):
+        """
+        :param max_bytes: maximum total size of the cached results (serialized)
+        :param max_entry_bytes: results bigger than this are not cached
+        :param ttl: seconds an entry stays valid
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (path, version, expiration, response, size)
+        self.versions = collections.Counter()  # path -> write counter
+        self.bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0, 'too_big': 0}
+
+    def version(self, path: str) -> tuple:
+        """Return the write counter and the file_stamp of path, a cached result is valid while they stay the same"""
+        return self.versions[path], file_stamp(path)
+
+    def bump(self, path: str) -> None:
+        """Mark every cached result of path as stale"""
+        with self.lock:
+            self.versions[path] += 1
+
+    def get(self, path: str, query: str, result_format: str):
+        """
+        :return: the cached response or None
+        :rtype: database.user.response.UserDatabaseResponse or None
+        """
+        key = (path, normalize(query), result_format)
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            if entry[1] != (self.versions[path], stamp) or entry[2] <= time.monotonic():
+                self._remove(key)
+                self.counters['stale'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            response = entry[3]
+        if response.query != query:
+            # same statement written differently, answer with the query as it was sent
+            response = copy.copy(response)
+            response.query = query
+        return response
+
+    def put(self, path: str, query: str, result_format: str, version: int, response) -> None:
+        """
+        Cache the response of a query
+        The results are serialized once here, hits send that json as is
+        :param version: version of path read before the query was executed
+        """
+        results_json = response._results_json or json.dumps(response.results)
+        size = len(results_json)
+        if size > self.max_entry_bytes:
+            with self.lock:
+                self.counters['too_big'] += 1
+            return
+        response._results_json = results_json
+        key = (path, normalize(query), result_format)
+        stamp = file_stamp(path)
+        with self.lock:
+            if version != (self.versions[path], stamp):
+                return  # a write happened meanwhile, the response may already be stale
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (path, version, time.monotonic() + self.ttl, response, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.bytes)
+
+    def _remove(self, key) -> None:
+        entry = self.entries.pop(key)
+        self.bytes -= entry[4]
+
+
+CACHE = ResultCache(
+    max_bytes=database.settings.RESULT_CACHE_MAX_BYTES,
+    max_entry_bytes=database.settings.RESULT_CACHE_MAX_ENTRY_BYTES,
+    ttl=database.settings.RESULT_CACHE_TTL,
+)
+database.metrics.Collected("result_cache", "Result cache counters, entries and bytes", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in CACHE.stats().items()})
@@ -0,0 +1,277 @@
+import atexit
+import collections
+import copy
+import json
+import logging
+import secrets
+import threading
+import time
+import database.settings
+import database.limits
+import database.metrics
+import database.user
+import database.user.response
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = "Cursor not found or expired"
+
+
+class ServerCursor:
+    """An open select of a paged query, its statement stays on the connection between the requests of its pages"""
+
+    def __init__(self, *, cursor_id: str, token_token: str, db: database.user.UserDatabase, response, chunks, page_size: int, max_bytes: int or None, ttl: float, max_age: float):
+        """
+        :param db: entered UserDatabase running the statement, exited when the cursor is closed
+        :param response: response of the query, its columns are the ones of every page
+        :param chunks: generator of the pages (lists of row tuples) from UserDatabase.execute_stream
+        :param max_bytes: maximum size of the results of a page (serialized), None for no limit
+        """
+        self.cursor_id = cursor_id
+        self.token_token = token_token
+        self.db = db
+        self.query = response.query
+        self.columns = response.columns
+        self.response = response
+        self.chunks = chunks
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        now = time.monotonic()
+        self.expires = now + ttl
+        self.dies = now + max_age
+        self.lock = threading.Lock()  # held while a page is read
+        self.closed = False
+
+    def expired(self, now: float) -> bool:
+        return now > self.expires or now > self.dies
+
+    def page(self, result_format: str):
+        """
+        Read the next page
+        :return: (response, whether rows may be left)
+        :rtype: (database.user.response.UserDatabaseResponse, bool)
+        """
+        start = time.perf_counter()
+        try:
+            rows = next(self.chunks, [])
+        except Exception as e:
+            response = database.user.response.UserDatabaseResponse.bad(self.query, error_message=str(e))
+            response.limit = self.response.limit
+            return response, False
+        response = database.user.response.UserDatabaseResponse.good(self.query, results=database.user.UserDatabase.shape(self.columns, rows, result_format), columns=self.columns)
+        if self.max_bytes is not None:
+            response._results_json = json.dumps(response.results)
+            if len(response._results_json) > self.max_bytes:
+                return database.user.response.UserDatabaseResponse.limited(self.query, 'max_bytes', self.max_bytes, f"Results are bigger than the {self.max_bytes} bytes allowed"), False
+        response._rows = len(rows)
+        response._duration = time.perf_counter() - start
+        self.expires = time.monotonic() + self.ttl
+        return response, len(rows) == self.page_size
+
+    def close(self) -> None:
+        """Finalize the statement and give the connection back to the pool, the lock must be held"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.chunks.close()
+            self.db._reset_cursor()
+        finally:
+            self.db.__exit__(None, None, None)
+
+
+class CursorStore:
+    """
+    Server-side cursors of the paged queries (page_size param), so every page costs its own rows only, unlike OFFSET
+    A cursor lives in the process that opened it and holds a pooled connection of its database (with its read snapshot) until it is closed:
+    once read to the end, after ttl seconds without a request, max_age seconds after it was opened, or to make room for a newer cursor of its token
+    """
+
+    def __init__(self, *, max_cursors: int, ttl: float, max_age: float, sweep_interval: float):
+        """
+        :param max_cursors: maximum amount of cursors open in this process
+        :param ttl: seconds a cursor is kept without a request for its next page
+        :param max_age: seconds a cursor is kept at most
+        :param sweep_interval: seconds between two looks for expired cursors
+        """
+        assert type(max_cursors) is int and max_cursors > 0
+
+        self.max_cursors = max_cursors
+        self.ttl = ttl
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.cursors = collections.OrderedDict()  # cursor_id -> ServerCursor, least recently used first
+        self.stopping = threading.Event()
+        self.thread = None
+        self.counters = {'opened': 0, 'finished': 0, 'expired': 0, 'evicted': 0, 'closed': 0}
+
+    def open(self, token, query: str, page_size: int, result_format: str):
+        """
+        Run a select and return its first page, the response carries the cursor of the next page if rows may be left
+        :type token: database.root.types.token.Token
+        :param page_size: rows per page, lowered to the max_rows of the token
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        assert type(page_size) is int and page_size > 0
+
+        self.start()
+        limits = copy.copy(token.limits)
+        max_bytes = limits.max_bytes
+        if limits.max_rows is not None:
+            page_size = min(page_size, limits.max_rows) or 1
+        # max_rows and max_bytes bound every page, not the whole cursor
+        limits.max_rows = limits.max_bytes = None
+
+        tier = database.limits.tier_settings(token.token_tier)
+        if tier.get('max_cursors') == 0:
+            return database.user.response.UserDatabaseResponse.bad(query, error_message="Paged queries are not allowed for this token")
+        evicted = self._make_room(token.token_token, tier.get('max_cursors'))
+        for cursor in evicted:
+            self._close(cursor, 'evicted')
+        with self.lock:
+            if len(self.cursors) >= self.max_cursors:
+                return database.user.response.UserDatabaseResponse.bad(query, error_message=f"Too many cursors open, the maximum is {self.max_cursors}")
+
+        db = database.user.UserDatabase(token.user_email, token.token_database_name, limits=limits).__enter__()
+        try:
+            response, chunks = db.execute_stream(query, page_size, 'rows')
+            if not response.ok:
+                chunks.close()
+                db.__exit__(None, None, None)
+                return response
+            cursor = ServerCursor(cursor_id=secrets.token_urlsafe(16), token_token=token.token_token, db=db, response=response, chunks=chunks, page_size=page_size, max_bytes=max_bytes, ttl=self.ttl, max_age=self.max_age)
+        except BaseException:
+            db.__exit__(None, None, None)
+            raise
+        cursor.lock.acquire()
+        with self.lock:
+            self.counters['opened'] += 1
+        return self._page(cursor, result_format, response._duration)
+
+    def next(self, token, cursor_id: str, result_format: str):
+        """
+        Return the next page of a cursor opened through token
+        :type token: database.root.types.token.Token
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        cursor = self._take(token, cursor_id)
+        if type(cursor) is str:
+            return database.user.response.UserDatabaseResponse.bad("", error_message=cursor)
+        return self._page(cursor, result_format)
+
+    def close(self, token, cursor_id: str):
+        """
+        Close a cursor before its end
+        :type token: database.root.types.token.Token
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        cursor = self._take(token, cursor_id)
+        if type(cursor) is str:
+            return database.user.response.UserDatabaseResponse.bad("", error_message=cursor)
+        self._close(cursor, 'closed')
+        return database.user.response.UserDatabaseResponse.good(cursor.query, columns=cursor.columns)
+
+    def _take(self, token, cursor_id: str) -> ServerCursor or str:
+        """Return the cursor out of the store with its lock held, or the error message"""
+        with self.lock:
+            cursor = self.cursors.get(cursor_id)
+            if cursor is None or cursor.token_token != token.token_token:
+                return NOT_FOUND
+            if not cursor.lock.acquire(blocking=False):
+                return "Cursor busy, its pages must be read one after the other"
+            del self.cursors[cursor_id]
+        if cursor.expired(time.monotonic()):
+            self._close(cursor, 'expired')
+            return NOT_FOUND
+        return cursor
+
+    def _page(self, cursor: ServerCursor, result_format: str, duration: float = 0.0):
+        """Read a page of cursor (out of the store, its lock held), put it back if rows may be left, close it otherwise"""
+        try:
+            response, more = cursor.page(result_format)
+        except BaseException:
+            self._close(cursor, 'closed')
+            raise
+        response._duration = (response._duration or 0.0) + duration
+        if not more:
+            self._close(cursor, 'finished' if response.ok else 'closed')
+            return response
+        response.cursor = cursor.cursor_id
+        with self.lock:
+            self.cursors[cursor.cursor_id] = cursor
+        cursor.lock.release()
+        return response
+
+    def _make_room(self, token_token: str, max_cursors: int or None) -> list:
+        """Take the least recently used cursors of token_token out of the store until it may open one more"""
+        if max_cursors is None:
+            return []
+        evicted = []
+        with self.lock:
+            cursors = [cursor for cursor in self.cursors.values() if cursor.token_token == token_token]
+            for cursor in cursors[:max(len(cursors) - max_cursors + 1, 0)]:
+                if cursor.lock.acquire(blocking=False):
+                    del self.cursors[cursor.cursor_id]
+                    evicted.append(cursor)
+        return evicted
+
+    def _close(self, cursor: ServerCursor, reason: str) -> None:
+        """Close a cursor already out of the store, its lock held"""
+        try:
+            cursor.close()
+        except Exception:
+            logger.exception("Could not close cursor of %s", cursor.db.path)
+        finally:
+            cursor.lock.release()
+        with self.lock:
+            self.counters[reason] += 1
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name="cursor-sweeper", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout: float or None = None) -> None:
+        """Close every cursor and stop the background thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopping.set()
+            thread.join(timeout)
+        self.sweep(close_all=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, open=len(self.cursors))
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.sweep_interval):
+            self.sweep()
+
+    def sweep(self, close_all: bool = False) -> None:
+        """Close the expired cursors (every cursor with close_all), the ones being read are left for later"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for cursor in list(self.cursors.values()):
+                if (close_all or cursor.expired(now)) and cursor.lock.acquire(blocking=False):
+                    del self.cursors[cursor.cursor_id]
+                    expired.append(cursor)
+        for cursor in expired:
+            self._close(cursor, 'expired')
+
+
+CURSORS = CursorStore(
+    max_cursors=database.settings.CURSOR_MAX_OPEN,
+    ttl=database.settings.CURSOR_TTL,
+    max_age=database.settings.CURSOR_MAX_AGE,
+    sweep_interval=min(database.settings.CURSOR_TTL, 5),
+)
+database.metrics.Collected("query_cursors", "Server-side cursors of paged queries: open, and closed by reason", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in CURSORS.stats().items()})
@@ -0,0 +1,285 @@
+import atexit
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+import threading
+import time
+import database.settings
+import database.log
+import database.metrics
+import database.locks
+import database.limits
+import database.pool
+import database.user
+import database.user.cache
+import database.user.response
+
+logger = logging.getLogger(__name__)
+
+CRASHED = "Query worker crashed"
+
+
+def hash_key(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to slots, only about 1/N of the keys move when the amount of slots changes"""
+
+    def __init__(self, slots: int, virtual_nodes: int):
+        """
+        :param slots: amount of slots, keys get 0 to slots - 1
+        :param virtual_nodes: points of each slot on the ring, more spread the keys more evenly
+        """
+        points = sorted([(hash_key(f"{slot}-{node}"), slot) for slot in range(slots) for node in range(virtual_nodes)])
+        self.hashes = [point[0] for point in points]
+        self.slots = [point[1] for point in points]
+
+    def slot(self, key: str) -> int:
+        index = bisect.bisect(self.hashes, hash_key(key))
+        return self.slots[index % len(self.slots)]
+
+
+def pack(response, shm_threshold: int) -> tuple:
+    """
+    Compact form of a response sent back by a worker: plain values and the results already serialized
+    Results bigger than shm_threshold bytes are handed over in a shared memory block instead of through the pipe
+    """
+    results_json = response._results_json
+    if results_json is None and response.results is not None:
+        results_json = json.dumps(response.results)
+    results = None if results_json is None else results_json.encode()
+    if results is not None and len(results) >= shm_threshold:
+        block = multiprocessing.shared_memory.SharedMemory(create=True, size=len(results))
+        block.buf[:len(results)] = results
+        if os.name == 'posix':
+            # the receiving process unlinks it, the resource tracker knows it by its POSIX name
+            multiprocessing.resource_tracker.unregister('/' + block.name, 'shared_memory')
+        block.close()
+        results = (block.name, len(results))
+    return response.status, response.query, response.error_message, response.lastrowid, response.columns, response.truncated, response.limit, response._rows, response._duration, results
+
+
+def unpack(packed: tuple):
+    """
+    :rtype: database.user.response.UserDatabaseResponse
+    """
+    status, query, error_message, lastrowid, columns, truncated, limit, rows, duration, results = packed
+    if type(results) is tuple:
+        block = multiprocessing.shared_memory.SharedMemory(name=results[0])
+        try:
+            results = bytes(block.buf[:results[1]])
+        finally:
+            block.close()
+            block.unlink()
+    response = database.user.response.UserDatabaseResponse(status, query, None, lastrowid, error_message, columns)
+    response.truncated = truncated
+    response.limit = limit
+    response._rows = rows
+    response._duration = duration
+    # results stay serialized, APIResponse.json sends them as they are
+    response._results_json = None if results is None else results.decode()
+    return response
+
+
+def work(conn, shm_threshold: int) -> None:
+    """Main loop of a worker process: run the queries received through conn, one at a time"""
+    database.log.setup()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        task_id, folder_name, database_name, query, result_format, limits = task
+        try:
+            with database.user.UserDatabase(folder_name, database_name, limits=limits) as db:
+                result = pack(db.execute(query, result_format), shm_threshold)
+        except database.pool.PoolTimeout as e:
+            result = e  # raised again by ProcessExecutor.execute, the API answers it with a 503
+        except Exception as e:
+            result = str(e)
+        conn.send((task_id, result))
+
+
+class Worker:
+    """One worker process and the thread reading its answers"""
+
+    def __init__(self, executor: 'ProcessExecutor', slot: int):
+        self.executor = executor
+        self.slot = slot
+        self.lock = threading.Lock()
+        self.pending = {}  # task id -> future
+        self.conn, child_conn = executor.context.Pipe()
+        self.process = executor.context.Process(target=work, args=(child_conn, executor.shm_threshold), name=f"query-worker-{slot}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.reader = threading.Thread(target=self.read, name=f"query-worker-{slot}-reader", daemon=True)
+        self.reader.start()
+
+    def submit(self, task_id: int, task: tuple) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.pending[task_id] = future
+            try:
+                self.conn.send((task_id,) + task)
+            except (OSError, ValueError):
+                del self.pending[task_id]
+                future.set_result(CRASHED)
+        return future
+
+    def read(self) -> None:
+        while True:
+            try:
+                task_id, result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(task_id, None)
+            if future is not None:
+                future.set_result(result)
+        # the process is gone, whatever it was running is lost
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.conn.close()
+        for future in pending.values():
+            future.set_result(CRASHED)
+        self.process.join(1)
+        self.executor.replace(self)
+
+    def stop(self) -> None:
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class ProcessExecutor:
+    """
+    Runs tenant queries in worker processes, so row materialization and serialization scale past the GIL
+    Every database is routed to a fixed worker (consistent hashing of its path), which keeps its connections and caches warm
+    A worker that dies is started again in the same slot, the reads it was running are sent once more, the writes fail
+    """
+
+    def __init__(self, *, processes: int, virtual_nodes: int, shm_threshold: int, start_method: str or None = None):
+        """
+        :param processes: amount of worker processes
+        :param virtual_nodes: points of each worker on the hash ring
+        :param shm_threshold: results of at least this many bytes (serialized) come back through shared memory
+        :param start_method: multiprocessing start method, defaults to 'spawn' (workers don't inherit the threads of the server)
+        """
+        assert type(processes) is int and processes > 0
+
+        self.processes = processes
+        self.shm_threshold = shm_threshold
+        self.context = multiprocessing.get_context(start_method or 'spawn')
+        self.ring = HashRing(processes, virtual_nodes)
+        self.lock = threading.Lock()
+        self.workers = [None] * processes
+        self.task_ids = itertools.count()
+        self.stopped = False
+        self.counters = {'tasks': 0, 'crashes': 0, 'retries': 0}
+
+    def worker(self, path: str) -> Worker:
+        slot = self.ring.slot(path)
+        with self.lock:
+            if self.stopped:
+                raise Exception("Query executor stopped")
+            if self.workers[slot] is None:
+                self.workers[slot] = Worker(self, slot)
+            return self.workers[slot]
+
+    def replace(self, worker: Worker) -> None:
+        """Forget a dead worker, a new one is started by the next query of its slot"""
+        with self.lock:
+            if self.workers[worker.slot] is worker:
+                self.workers[worker.slot] = None
+                if not self.stopped:
+                    self.counters['crashes'] += 1
+                    logger.error("Query worker %d exited with code %s", worker.slot, worker.process.exitcode)
+
+    def execute(self, folder_name: str, database_name: str, query: str, result_format: str, limits: database.limits.QueryLimits or None):
+        """
+        Execute ONE query in the worker of its database
+        :rtype: database.user.response.UserDatabaseResponse
+        """
+        path = database.user.UserDatabase.path_of(folder_name, database_name)
+        task = (folder_name, database_name, query, result_format, limits)
+        for attempt in range(2):
+            with self.lock:
+                self.counters['tasks'] += 1
+                task_id = next(self.task_ids)
+            result = self.worker(path).submit(task_id, task).result()
+            if result != CRASHED or not database.locks.is_read(query) or attempt:
+                break
+            with self.lock:
+                self.counters['retries'] += 1
+        if isinstance(result, database.pool.PoolTimeout):
+            raise result
+        if type(result) is str:
+            return database.user.response.UserDatabaseResponse.bad(query, error_message=result)
+        return unpack(result)
+
+    def stop(self) -> None:
+        with self.lock:
+            self.stopped = True
+            workers, self.workers = self.workers, [None] * self.processes
+        for worker in workers:
+            if worker is not None:
+                worker.stop()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, alive=len([worker for worker in self.workers if worker is not None]))
+
+
+EXECUTOR = None
+if database.settings.EXECUTOR_PROCESSES:
+    EXECUTOR = ProcessExecutor(
+        processes=database.settings.EXECUTOR_PROCESSES,
+        virtual_nodes=database.settings.EXECUTOR_VIRTUAL_NODES,
+        shm_threshold=database.settings.EXECUTOR_SHM_THRESHOLD,
+    )
+    atexit.register(EXECUTOR.stop)
+    database.metrics.Collected("query_executor", "Query worker processes: tasks, crashes, retries and workers alive", 'gauge', ('stat',), lambda: {(stat,): value for stat, value in EXECUTOR.stats().items()})
+
+
+def execute(folder_name: str, database_name: str, query: str, result_format: str = 'objects', cache: bool = False, limits: database.limits.QueryLimits or None = None):
+    """
+    Execute ONE query of a tenant database, in a worker process if EXECUTOR_PROCESSES is set, in this thread otherwise
+    Same arguments as UserDatabase.execute, the result cache stays in this process
+    :rtype: database.user.response.UserDatabaseResponse
+    """
+    if EXECUTOR is None:
+        with database.user.UserDatabase(folder_name, database_name, limits=limits) as db:
+            return db.execute(query, result_format, cache=cache)
+
+    path = database.user.UserDatabase.path_of(folder_name, database_name)
+    read = database.locks.is_read(query)
+    cache = cache and database.settings.RESULT_CACHE_ENABLED and read
+    if cache:
+        response = database.user.cache.CACHE.get(path, query, result_format)
+        if response is not None and (limits is None or limits.allows(response)):
+            return response
+    version = database.user.cache.CACHE.version(path)
+    start = time.perf_counter()
+    response = EXECUTOR.execute(folder_name, database_name, query, result_format, limits)
+    database.metrics.EXECUTOR_SECONDS.observe(time.perf_counter() - start)
+    database.metrics.QUERIES.inc(database.metrics.database_label(path), response.status)
+    if not read:
+        database.user.cache.CACHE.bump(path)
+    elif cache and response.ok and not response.truncated:
+        database.user.cache.CACHE.put(path, query, result_format, version, response)
+    return response
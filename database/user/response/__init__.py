@@ -2,9 +2,8 @@ import database.response
 
 
 class UserDatabaseResponse(database.response.DatabaseResponse):
-    def __init__(self, status: int, query: str, response: list or None = None, lastrowid: int or None = None, error_message: str or None = None):
-        super().__init__(status, query, response, lastrowid, error_message)
-        print(self)
+    def __init__(self, status: int, query: str, response: list or None = None, lastrowid: int or None = None, error_message: str or None = None, columns: list or None = None):
+        super().__init__(status, query, response, lastrowid, error_message, columns)
 
 
 if __name__ == "__main__":
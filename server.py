@@ -1,24 +1,54 @@
-from flask import Flask, request, session, redirect, url_for, g, render_template
+from flask import Flask, Response, request, session, redirect, url_for, g, render_template
 from functools import wraps
+import api_encoding
 import api_response
+import database.locks
+import database.log
+import database.metrics
+import database.pool
 import database.response
+import database.settings
 import database.user
+import database.user.executor
+import database.user.cursors
 import database.root.types.user
 import database.root.types.token
+import database.root.mail
 import json
 import hashlib
 import os
 import re
+import time
+import logging
 
-# TODO: setup logging
 # TODO: treat web pages errors better
 
 current_dir = os.path.dirname(__file__)
-with open(os.path.join(current_dir, "config.json")) as file:
+with open(os.environ.get('DATABASE_API_CONFIG', os.path.join(current_dir, "config.json"))) as file:
     CONFIG = json.load(file)
 TOKEN_KEY = CONFIG["token_secret_key"]
 app = Flask(__name__, template_folder="templates")
 app.secret_key = CONFIG['flask_secret_key']
+logger = logging.getLogger(__name__)
+
+
+@app.before_request
+def start():
+    """
+    Start the log writer and the mail dispatcher (which sends the mails left in the outbox by a previous run), both only once per process
+    Done here rather than on import: the query worker processes (spawn) import this module again when it is the one run
+    """
+    database.log.setup()
+    database.root.mail.DISPATCHER.start()
+
+
+@app.errorhandler(database.pool.PoolTimeout)
+def pool_timeout(error: database.pool.PoolTimeout):
+    """Busy server: the API answers a json 503 (query, stream, page and batch routes), the pages a plain one, both with Retry-After"""
+    logger.warning("%s: %s", request.url, error)
+    if request.path.startswith('/api/'):
+        return api_response.APIResponse.unavailable(query=request.url, error_message="Server too busy, no database connection became available in time").get_response()
+    return Response("Service unavailable, try again later\n", status=503, mimetype='text/plain', headers={'Retry-After': str(database.settings.POOL_RETRY_AFTER)})
 
 
 # ----------------------------------------------------------- GENERAL -----------------------------------------------------------
@@ -60,25 +90,14 @@ def docs():
 def restricted_token_access(func):
     @wraps(func)
     def authenticate_token(*args, **kwargs):
-
-        if request.method == "GET":
-            token_token = request.args.get('token')
-            if token_token:
-                try:
-                    with database.root.RootDatabase() as root_db:
-                        results = root_db.select_tokens(token_token=token_token)
-                except:
-                    return api_response.APIResponse.bad(query=request.url, error_message="Invalid token").get_response()
-                else:
-                    if results:
-                        token = results[0]
-                        if token.token_active != 1:
-                            return api_response.APIResponse.bad(query=request.url, error_message="Token not active").get_response()
-                        return func(*args, token=token, **kwargs)
-                    else:
-                        return api_response.APIResponse.bad(query=request.url, error_message="Token not found").get_response()
-
-            return api_response.APIResponse.bad(query=request.url, error_message="Missing token").get_response()
+        token_token = request.args.get('token')
+        if not token_token and request.method == "POST":
+            body = request.get_json(silent=True)
+            token_token = body.get('token') if isinstance(body, dict) else None
+        token, error_response = api_response.authorize(request.url, token_token)
+        if error_response is not None:
+            return error_response.get_response()
+        return func(*args, token=token, **kwargs)
 
     return authenticate_token
 
@@ -87,18 +106,122 @@ def restricted_token_access(func):
 @restricted_token_access
 def database_use(token: database.root.types.token.Token):
     try:
-        query = request.args['q']
+        # the next pages of a paged query only need its cursor
+        query = request.args['q'] if 'cursor' not in request.args else request.args.get('q', '')
     except KeyError:
         return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message="Arguments missing: q").get_response()
     except:
         pass
     else:
-        with database.user.UserDatabase(token.user_email, token.token_database_name) as db:
-            return api_response.APIResponse.good(query=request.url, token_token=token.token_token, database_response=db.execute(query)).get_response()
+        result_format = request.args.get('format', 'objects')
+        if result_format not in database.user.RESULT_FORMATS:
+            return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message=f"Invalid format: {result_format}").get_response()
+        encoding = api_encoding.negotiate(request.headers.get('Accept'))
+        if encoding is None:
+            return api_response.APIResponse(status=406, query=request.url, token_token=token.token_token, error_message=f"Not acceptable, the results can be sent as: {', '.join(api_encoding.MEDIA_TYPES)}").get_response()
+        content_coding = api_encoding.negotiate_coding(request.headers.get('Accept-Encoding'))
+        # csv and arrow need the rows as lists of values
+        result_format = api_encoding.ENCODERS[encoding].row_format or result_format
+        if 'cursor' in request.args or 'page_size' in request.args:
+            return database_page(token, query, result_format, encoding, content_coding)
+        if request.args.get('stream'):
+            if result_format == 'columns':
+                return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message="Format columns can't be streamed").get_response()
+            return database_stream(token, query, result_format, encoding, content_coding)
+        database_response = database.user.executor.execute(token.user_email, token.token_database_name, query, result_format, cache=bool(request.args.get('cache')), limits=token.limits)
+        return api_response.APIResponse.good(query=request.url, token_token=token.token_token, database_response=database_response).get_response(encoding, content_coding)
 
     return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message="Unkown error").get_response()
 
 
+def database_page(token: database.root.types.token.Token, query: str, result_format: str, encoding: str, content_coding: str or None):
+    """
+    Answer a page of a paged query: page_size opens a cursor on a select and sends its first page, cursor sends the next one (close=1 closes it)
+    The database_response cursor is the continuation token of the next page, null once every row was sent
+    """
+    cursor_id = request.args.get('cursor')
+    if cursor_id is not None:
+        if request.args.get('close'):
+            database_response = database.user.cursors.CURSORS.close(token, cursor_id)
+        else:
+            database_response = database.user.cursors.CURSORS.next(token, cursor_id, result_format)
+        return api_response.APIResponse.good(query=request.url, token_token=token.token_token, database_response=database_response).get_response(encoding, content_coding)
+
+    try:
+        page_size = int(request.args['page_size'])
+        assert page_size > 0
+    except (ValueError, AssertionError):
+        return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message=f"Invalid page_size: {request.args['page_size']}").get_response()
+    if request.args.get('stream'):
+        return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message="Paged queries can't be streamed").get_response()
+    if not database.locks.is_read(query):
+        # nothing to page through
+        database_response = database.user.executor.execute(token.user_email, token.token_database_name, query, result_format, limits=token.limits)
+    else:
+        database_response = database.user.cursors.CURSORS.open(token, query, page_size, result_format)
+    return api_response.APIResponse.good(query=request.url, token_token=token.token_token, database_response=database_response).get_response(encoding, content_coding)
+
+
+def database_stream(token: database.root.types.token.Token, query: str, result_format: str, encoding: str, content_coding: str or None):
+    """Answer a query writing its results while they are read, the database stays checked out until the body is sent"""
+    url = request.url
+
+    def generate():
+        with database.user.UserDatabase(token.user_email, token.token_database_name, limits=token.limits) as db:
+            database_response, chunks = db.execute_stream(query, database.settings.STREAM_CHUNK_SIZE, result_format)
+            yield api_response.APIResponse.good(query=url, token_token=token.token_token, database_response=database_response)
+            yield from chunks
+
+    chunks = generate()
+    response = next(chunks)
+    return response.get_stream_response(chunks, encoding, content_coding)
+
+
+@app.route("/metrics")
+def metrics():
+    """Hot path timers and counters in the Prometheus text format, only for METRICS_ALLOWED_ADDRESSES"""
+    if request.remote_addr not in database.settings.METRICS_ALLOWED_ADDRESSES:
+        return Response("Forbidden\n", status=403, mimetype='text/plain')
+    return Response(database.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/api/v1/batch/", methods=["POST"])
+@restricted_token_access
+def database_batch(token: database.root.types.token.Token):
+    """
+    Run many statements in one transaction, the body is a json object:
+    {"statements": [{"q": query, "params": [...]}, {"q": query, "many": [[...], ...]}, ...], "mode": "transaction" or "savepoint", "format": "objects"}
+    """
+    body = request.get_json(silent=True)
+    error_message = None
+    if not isinstance(body, dict) or not isinstance(body.get('statements'), list) or not body['statements']:
+        error_message = "Arguments missing: statements"
+    elif len(body['statements']) > database.settings.BATCH_MAX_STATEMENTS:
+        error_message = f"Too many statements, the maximum is {database.settings.BATCH_MAX_STATEMENTS}"
+    elif body.get('mode', 'transaction') not in database.user.BATCH_MODES:
+        error_message = f"Invalid mode: {body.get('mode')}"
+    elif body.get('format', 'objects') not in database.user.RESULT_FORMATS:
+        error_message = f"Invalid format: {body.get('format')}"
+    else:
+        for number, statement in enumerate(body['statements']):
+            if not isinstance(statement, dict) or not isinstance(statement.get('q'), str):
+                error_message = f"Invalid statement {number}: missing q"
+            elif not isinstance(statement.get('params', []), (list, dict)):
+                error_message = f"Invalid statement {number}: params must be a list or an object"
+            elif 'many' in statement and (not isinstance(statement['many'], list) or not all([isinstance(params, (list, dict)) for params in statement['many']])):
+                error_message = f"Invalid statement {number}: many must be a list of lists or objects"
+            elif database.locks.controls_transaction(statement['q']):
+                error_message = f"Invalid statement {number}: the batch is a transaction of its own, BEGIN, COMMIT, END, ROLLBACK, SAVEPOINT and RELEASE are not allowed"
+            if error_message:
+                break
+    if error_message:
+        return api_response.APIResponse.bad(query=request.url, token_token=token.token_token, error_message=error_message).get_response()
+
+    with database.user.UserDatabase(token.user_email, token.token_database_name, limits=token.limits) as db:
+        database_response = db.execute_batch(body['statements'], body.get('mode', 'transaction'), body.get('format', 'objects'))
+        return api_response.APIResponse.good(query=request.url, token_token=token.token_token, database_response=database_response).get_response()
+
+
 #
 
 #
@@ -116,21 +239,43 @@ def database_use(token: database.root.types.token.Token):
 #
 
 # ----------------------------------------------------------- USER -----------------------------------------------------------
-@app.before_request
-def before_request():
-    g.user = None
-    if 'user_id' in session:
-        try:
-            g.user = database.root.types.user.User.get(user_id=session['user_id'])
-        except Exception as e:
-            print(e)
-            g.user = None
+def current_user():
+    """
+    Return the logged in user (or None), loaded only by the routes that ask for it and at most once per request
+    The signed session carries the user fields, they are checked against root.db (through the user cache) once USER_SESSION_TTL has passed
+    :rtype: database.root.types.user.User or None
+    """
+    if 'user' not in g:
+        g.user = None
+        if 'user_id' in session:
+            try:
+                # sessions made before a field was added to SESSION_FIELDS are loaded from root.db once
+                if set(database.root.types.user.SESSION_FIELDS) <= set(session.get('user', ())) and time.time() - session.get('user_checked', 0) < database.settings.USER_SESSION_TTL:
+                    g.user = database.root.types.user.User.from_session(session['user'])
+                else:
+                    g.user = database.root.types.user.User.get_cached(user_id=session['user_id'])
+                    login_session(g.user)
+            except Exception:
+                logger.exception("Could not load user %s", session['user_id'])
+                g.user = None
+    return g.user
+
+
+def login_session(user: database.root.types.user.User):
+    session['user_id'] = user.user_id
+    session['user'] = user.session_payload()
+    session['user_checked'] = time.time()
+
+
+def logout_session():
+    for key in ('user_id', 'user', 'user_checked'):
+        session.pop(key, None)
 
 
 def restricted_login_access(func):
     @wraps(func)
     def authenticate_login(*args, **kwargs):
-        if not g.user:
+        if not current_user():
             return redirect(url_for("login"))
         return func(*args, **kwargs)
 
@@ -140,14 +285,14 @@ def restricted_login_access(func):
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
-        session.pop("user_id", None)
+        logout_session()
         user_fullname = request.form['fullname']
         user_email = request.form['email']
         user_password = hashlib.sha256(bytes(request.form['password'], 'utf8')).hexdigest()
 
         try:
             user = database.root.types.user.User.create(user_fullname=user_fullname, user_email=user_email, user_password=user_password)
-            session['user_id'] = user.user_id
+            login_session(user)
             return redirect(url_for("profile"))
         except Exception as e:
             return render_template("signup.html", error_message="* Something went wrong while creating the account, maybe its already created" + str(e))
@@ -157,14 +302,14 @@ def signup():
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
-        session.pop('user_id', None)
+        logout_session()
 
         user_email = request.form['email']
         user_password = hashlib.sha256(bytes(request.form['password'], 'utf8')).hexdigest()
         try:
             user = database.root.types.user.User.get(user_email=user_email)
             if user.check_pass(user_password):
-                session['user_id'] = user.user_id
+                login_session(user)
                 return redirect(url_for("profile"))
         except:
             pass
@@ -231,9 +376,9 @@ def database_create():
 def database_stats():
     # TODO: create disable button
     # TODO: create delete button
-    # TODO: limit amount of use shown
 
     token_id = request.args.get('token_id')
+    before_use_id = request.args.get('before', type=int)
     if token_id:
         # token query found
         try:
@@ -241,10 +386,11 @@ def database_stats():
             # token found
             if token.user_id == g.user.user_id:
                 # match user
-                uses = token.get_uses()
-                return render_template('database_stats.html', token=token, uses=uses)
-        except Exception as e:
-            print(e)
+                uses = token.get_uses_page(limit=database.settings.STATS_PAGE_SIZE, before_use_id=before_use_id)
+                older_use_id = uses[-1].use_id if len(uses) == database.settings.STATS_PAGE_SIZE else None
+                return render_template('database_stats.html', token=token, uses=uses, summary=token.get_use_summary(), older_use_id=older_use_id)
+        except Exception:
+            logger.exception("Could not show stats of token %s", token_id)
             raise
 
     return redirect(url_for('profile'))
@@ -253,6 +399,8 @@ def database_stats():
 if __name__ == "__main__":
     import platform
 
+    start()
+
     if platform.system() == "Windows":
         app.run("127.0.0.4", port=80, debug=True)
         # app.run("127.0.0.4", port=5478, debug=True)
@@ -0,0 +1,27 @@
+"""
+Tests of the app, run from the repository root with
+    python -m unittest
+The app is pointed to a temporary config and data directory before any of it is imported
+"""
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORY = tempfile.mkdtemp(prefix="database-api-tests-")
+with open(os.path.join(DIRECTORY, 'config.json'), 'w') as file:
+    json.dump({
+        'token_secret_key': 'tests',
+        'flask_secret_key': 'tests',
+        'GMAIL_APP_PASSWORD': '',
+        'ROOT_RELATIVE_PATH': os.path.join(DIRECTORY, 'root'),
+        'USER_RELATIVE_PATH': os.path.join(DIRECTORY, 'user'),
+        'MAIL_TRANSPORT': 'file',
+        'MAIL_FILE_PATH': os.path.join(DIRECTORY, 'mail.mbox'),
+    }, file)
+os.environ['DATABASE_API_CONFIG'] = os.path.join(DIRECTORY, 'config.json')
+sys.path.insert(0, ROOT)
+atexit.register(shutil.rmtree, DIRECTORY, True)
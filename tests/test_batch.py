@@ -0,0 +1,60 @@
+"""Atomicity of /api/v1/batch/ and UserDatabase.execute_batch"""
+import unittest
+import database.root
+import database.user
+import server
+
+
+class BatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with database.root.RootDatabase() as root_db:
+            user = root_db.insert_user(user_fullname="Batch Test", user_email="batch@example.com", user_password="batch")
+            token = root_db.insert_token(user_id=user.user_id, token_token="batch-token", token_database_name="batch")
+            root_db.update_token(token_id=token.token_id, token_active=1, token_tier='unlimited')
+        cls.client = server.app.test_client()
+
+    def setUp(self):
+        with database.user.UserDatabase("batch@example.com", "batch") as db:
+            db.execute("DROP TABLE IF EXISTS t")
+            db.execute("CREATE TABLE t (a)")
+
+    def rows(self) -> list:
+        with database.user.UserDatabase("batch@example.com", "batch") as db:
+            return db.execute("SELECT a FROM t ORDER BY a", 'rows').results
+
+    def batch(self, statements: list, mode: str = 'transaction') -> dict:
+        return self.client.post('/api/v1/batch/', json={'token': 'batch-token', 'mode': mode, 'statements': statements}).get_json()
+
+    def test_commit_is_refused(self):
+        response = self.batch([{'q': "INSERT INTO t VALUES (1)"}, {'q': "COMMIT"}, {'q': "INSERT INTO t VALUES (2)"}, {'q': "SELECT * FROM nope"}])
+        self.assertEqual(response['status'], 400)
+        self.assertIn("Invalid statement 1", response['error_message'])
+        self.assertEqual(self.rows(), [])
+
+    def test_failing_batch_leaves_nothing(self):
+        response = self.batch([{'q': "INSERT INTO t VALUES (1)"}, {'q': "INSERT INTO t VALUES (2)"}, {'q': "SELECT * FROM nope"}])
+        self.assertEqual(response['database_response']['status'], 400)
+        self.assertEqual(self.rows(), [])
+
+    def test_transaction_control_is_denied_by_the_database(self):
+        # not recognized by its first word, the authorizer of the batch statements refuses it
+        for mode in database.user.BATCH_MODES:
+            for statement in ("/* early */ COMMIT", "/* early */ RELEASE batch_statement", "/* early */ ROLLBACK"):
+                with database.user.UserDatabase("batch@example.com", "batch") as db:
+                    response = db.execute_batch([{'q': "INSERT INTO t VALUES (1)"}, {'q': statement}, {'q': "SELECT * FROM nope"}], mode)
+                self.assertFalse(response.ok)
+                self.assertFalse(response.results[1].ok, statement)
+                expected = [] if mode == 'transaction' else [(1,)]
+                self.assertEqual(self.rows(), expected, (mode, statement))
+                self.setUp()
+
+    def test_successful_batch_is_committed(self):
+        response = self.batch([{'q': "INSERT INTO t VALUES (?)", 'many': [[1], [2]]}, {'q': "SELECT count(*) FROM t"}])
+        self.assertEqual(response['database_response']['status'], 200)
+        self.assertEqual(self.rows(), [(1,), (2,)])
+
+
+if __name__ == "__main__":
+    unittest.main()
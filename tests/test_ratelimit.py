@@ -0,0 +1,55 @@
+"""Rate limits and daily quotas of the token tiers"""
+import types
+import unittest
+import database.settings
+import database.root.ratelimit
+
+
+def token(token_id: int, tier: str):
+    return types.SimpleNamespace(token_id=token_id, token_token=f"token-{token_id}", token_tier=tier)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = database.root.ratelimit.RateLimiter(max_tokens=100, flush_interval=3600)
+
+    def tearDown(self):
+        # nothing is written to root.db
+        self.limiter.pending.clear()
+        self.limiter.stop()
+
+    def test_default_tier_is_limited(self):
+        rate = database.settings.TOKEN_TIERS['default']['rate']
+        burst = database.settings.TOKEN_TIERS['default']['burst']
+        default = token(1, 'default')
+        errors = [self.limiter.check(default)[0] for _ in range(burst + rate + 50)]
+        self.assertIn(f"Rate limit exceeded: {rate} requests per second", errors)
+
+    def test_unlimited_tier_is_never_limited(self):
+        unlimited = token(2, 'unlimited')
+        for _ in range(1000):
+            self.assertEqual(self.limiter.check(unlimited), (None, None))
+        self.assertEqual(self.limiter.stats()['limited'], 0)
+        self.assertEqual(self.limiter.stats()['over_quota'], 0)
+
+    def test_unknown_tier_gets_the_default_one(self):
+        unknown = token(3, 'no such tier')
+        burst = database.settings.TOKEN_TIERS['default']['burst']
+        errors = [self.limiter.check(unknown)[0] for _ in range(burst + 50)]
+        self.assertTrue(any(errors))
+
+    def test_tier_slower_than_one_request_per_second(self):
+        slow = token(4, 'slow')
+        database.settings.TOKEN_TIERS['slow'] = {'rate': 0.5}
+        try:
+            self.assertEqual(self.limiter.check(slow), (None, None))
+            error_message, retry_after = self.limiter.check(slow)
+        finally:
+            del database.settings.TOKEN_TIERS['slow']
+        self.assertEqual(error_message, "Rate limit exceeded: 0.5 requests per second")
+        self.assertGreater(retry_after, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()